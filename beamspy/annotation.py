@@ -3,20 +3,50 @@
 
 import os
 import time
+import functools
 import itertools
 import gzip
 import sqlite3
+import uuid
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
 import requests
 import pandas as pd
 import numpy as np
 import networkx as nx
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from pyteomics import mass as pyteomics_mass
 from beamspy.in_out import read_molecular_formulae
 from beamspy.in_out import read_compounds
 from beamspy.auxiliary import nist_database_to_pyteomics
 from beamspy.auxiliary import composition_to_string
+from beamspy.auxiliary import order_composition_by_hill
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BATCH_SIZE = 10000  # number of records per executemany() when writing results
+
+_CHNOPS = frozenset(("C", "H", "N", "O", "P", "S"))
+
+
+def _connect_results_db(path):
+    # result databases are rebuilt from scratch on every run, so durability
+    # pragmas are traded for write speed; also applies to :memory: databases,
+    # where only the temp_store/cache_size pragmas have an effect
+    # uri=True so "file:" names (e.g. in-memory databases shared across
+    # connections) are accepted; plain paths are opened as before
+    conn = sqlite3.connect(path, uri=True)
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA journal_mode = MEMORY")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA cache_size = -64000")
+    return conn, cursor
 
 
 def calculate_mz_tolerance(mass, ppm):
@@ -29,26 +59,33 @@ def calculate_ppm_error(mass, theo_mass):
     return float(theo_mass - mass) / (theo_mass * 0.000001)
 
 
-def _remove_elements_from_compositions(records, keep):
+@functools.lru_cache(maxsize=4)
+def _nist_database(path):
+    # parsing the NIST table is expensive and the result is read-only here,
+    # so one parse per path serves all annotate_* calls and DB loads
+    return nist_database_to_pyteomics(path)
 
-    path_nist_database = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nist_database.txt')
-    nist_database = nist_database_to_pyteomics(path_nist_database)
 
-    elements = [e for e in nist_database if e not in keep]
-    for record in records:
-        for e in elements:
-            if "composition" in record:
-                record["composition"].pop(e, None)
-            else:
-                record.pop(e, None)
-    return records
+try:
+    _json_normalize = pd.json_normalize
+except AttributeError:  # pandas < 1.0
+    from pandas.io.json import json_normalize as _json_normalize
+
 
+def _records_to_frame(records, columns):
+    # expand the composition dicts and drop non-CHNOPS elements in one
+    # pandas pass instead of per-record pops in Python
+    df = _json_normalize(records)
+    df.columns = [c.replace("composition.", "") for c in df.columns]
+    return df.reindex(columns=columns).fillna(0)
 
-def _flatten_composition(records):
-    for record in records:
-        record.update(record["composition"])
-        del record["composition"]
-    return records
+
+# structure-of-arrays layout for library pairs; charges are kept as Python
+# objects so int/float charge states survive the round trip into the output
+_LIB_PAIRS_DTYPE = [("label_a", "O"), ("label_b", "O"),
+                    ("mass_a", "f8"), ("mass_b", "f8"),
+                    ("charge_a", "O"), ("charge_b", "O"),
+                    ("mass_diff", "f8"), ("has_diff", "?")]
 
 
 def _prep_lib(lib):
@@ -57,50 +94,57 @@ def _prep_lib(lib):
         combs = list(itertools.combinations(lib, 2))
         for pair in combs:
             if isinstance(lib[pair[0]], float):
-                lib_pairs.append(OrderedDict([(pair[0], {"mass": lib[pair[0]], "charge": 1}),
-                                              (pair[1], {"mass": lib[pair[1]], "charge": 1})]))
+                lib_pairs.append((pair[0], pair[1], lib[pair[0]], lib[pair[1]], 1, 1, 0.0, False))
             else:
-                lib_pairs.append(OrderedDict([(pair[0], {"mass": lib[pair[0]]["mass"], "charge": lib[pair[0]]["charge"]}),
-                                              (pair[1], {"mass": lib[pair[1]]["mass"], "charge": lib[pair[1]]["charge"]})]))
-        lib_pairs = sorted(lib_pairs, key=lambda pair: (list(pair.items())[0][1]["mass"] - list(pair.items())[1][1]["mass"]), reverse=True)
-        return lib_pairs
+                lib_pairs.append((pair[0], pair[1], lib[pair[0]]["mass"], lib[pair[1]]["mass"],
+                                  lib[pair[0]]["charge"], lib[pair[1]]["charge"], 0.0, False))
+        lib_pairs = np.array(lib_pairs, dtype=_LIB_PAIRS_DTYPE)
+        return lib_pairs[np.argsort(lib_pairs["mass_b"] - lib_pairs["mass_a"], kind="stable")]
     elif isinstance(lib, list) and isinstance(lib[0], OrderedDict):
         if "mass_difference" in lib[0]:
-            return sorted(lib, key=lambda d: d["mass_difference"], reverse=True)
+            for lib_pair in lib:
+                (label_a, values_a), (label_b, values_b) = list(lib_pair.items())[0:2]
+                lib_pairs.append((label_a, label_b, 0.0, 0.0,
+                                  values_a.get("charge", 1), values_b.get("charge", 1),
+                                  lib_pair["mass_difference"], True))
+            lib_pairs = np.array(lib_pairs, dtype=_LIB_PAIRS_DTYPE)
+            return lib_pairs[np.argsort(-lib_pairs["mass_diff"], kind="stable")]
         else:
             raise ValueError("Format library incorrect")
-        #else:
-        #    return sorted(lib_pairs, key=lambda pair: (list(pair.items())[0][1]["mass"] - list(pair.items())[1][1]["mass"]), reverse=True)
     else:
         raise ValueError("Incorrect format for library: {}".format(type(lib)))
 
 
-def _annotate_artifacts(peaklist, diff=0.02):
-    n = peaklist.iloc[:, 1]
+def _annotate_artifacts(mzs, ids, diff=0.02):
+    # sweep over the sorted mz values; only windows narrower than diff
+    # can qualify, so the inner loop stops at the first mz out of range
+    order = np.argsort(mzs, kind="stable")
+    mzs_sorted = mzs[order]
+    ids_sorted = ids[order]
+    n = mzs_sorted.shape[0]
     for i in range(n):
-        for j in range(i + 1, n):
-            mz_diff = peaklist.iloc[i,1] - peaklist.iloc[j,1]
-            ppm_error = calculate_ppm_error(peaklist.iloc[i,1], peaklist.iloc[j,1])
-            if abs(mz_diff) < diff:
-                yield i, j, mz_diff, ppm_error
+        j = i + 1
+        while j < n and mzs_sorted[j] - mzs_sorted[i] < diff:
+            mz_diff = mzs_sorted[i] - mzs_sorted[j]
+            ppm_error = calculate_ppm_error(mzs_sorted[i], mzs_sorted[j])
+            yield ids_sorted[i], ids_sorted[j], mz_diff, ppm_error
+            j += 1
 
 
 def _check_tolerance(mz_x, mz_y, lib_pair, ppm):
     min_tol_a, max_tol_a = calculate_mz_tolerance(mz_x, ppm)
     min_tol_b, max_tol_b = calculate_mz_tolerance(mz_y, ppm)
-    if "mass_difference" in lib_pair.keys():
+    if lib_pair["has_diff"]:
         # Need to fix the order, charge is one
-        min_tol_b = (min_tol_b - lib_pair["mass_difference"])
-        max_tol_b = (max_tol_b - lib_pair["mass_difference"])
-    elif "mass" in list(lib_pair.items())[0][1]:
+        min_tol_b = (min_tol_b - lib_pair["mass_diff"])
+        max_tol_b = (max_tol_b - lib_pair["mass_diff"])
+    else:
         # Need to fix the order
-        min_tol_a = (min_tol_a - list(lib_pair.items())[0][1]["mass"]) * list(lib_pair.items())[0][1]["charge"]
-        max_tol_a = (max_tol_a - list(lib_pair.items())[0][1]["mass"]) * list(lib_pair.items())[0][1]["charge"]
+        min_tol_a = (min_tol_a - lib_pair["mass_a"]) * lib_pair["charge_a"]
+        max_tol_a = (max_tol_a - lib_pair["mass_a"]) * lib_pair["charge_a"]
 
-        min_tol_b = (min_tol_b - list(lib_pair.items())[1][1]["mass"]) * list(lib_pair.items())[1][1]["charge"]
-        max_tol_b = (max_tol_b - list(lib_pair.items())[1][1]["mass"]) * list(lib_pair.items())[1][1]["charge"]
-    else:
-        raise ValueError("Incorrect format: {}".format(lib_pair))
+        min_tol_b = (min_tol_b - lib_pair["mass_b"]) * lib_pair["charge_b"]
+        max_tol_b = (max_tol_b - lib_pair["mass_b"]) * lib_pair["charge_b"]
     #if min_tol_b > min_tol_a and min_tol_b > max_tol_a:
     #    return -1
 
@@ -114,77 +158,191 @@ def _check_tolerance(mz_x, mz_y, lib_pair, ppm):
     return 0
 
 
+def _lib_pairs_to_arrays(lib_pairs):
+    # per-entry mass/charge arrays for the tolerance scan; mass_difference
+    # entries are treated as mass_a = 0.0, mass_b = difference, charge 1
+    has_diff = lib_pairs["has_diff"]
+    mass_a = np.where(has_diff, 0.0, lib_pairs["mass_a"])
+    mass_b = np.where(has_diff, lib_pairs["mass_diff"], lib_pairs["mass_b"])
+    charge_a = np.where(has_diff, 1.0, lib_pairs["charge_a"].astype(np.float64))
+    charge_b = np.where(has_diff, 1.0, lib_pairs["charge_b"].astype(np.float64))
+    return mass_a, mass_b, charge_a, charge_b
+
+
+def _max_mz_delta(mzs, mass_a, mass_b, charge_a, charge_b):
+    # upper bound on mzs[j] * (1 - tol) - mzs[i] * (1 + tol) for a matching
+    # pair; only valid as a sweep window when mzs is sorted ascending and
+    # the library entries do not mix charge states
+    if np.all(np.diff(mzs) >= 0.0) and np.all(charge_a == charge_b):
+        return np.max(mass_b - mass_a)
+    return np.inf
+
+
+def _scan_pairs(mzs, mass_a, mass_b, charge_a, charge_b, ppm, max_delta):
+    # two passes so the output buffers can be preallocated (numba compatible)
+    n = mzs.shape[0]
+    n_lib = mass_a.shape[0]
+    n_hits = 0
+    for p in range(2):
+        if p == 1:
+            i_arr = np.zeros(n_hits, dtype=np.int64)
+            j_arr = np.zeros(n_hits, dtype=np.int64)
+            k_arr = np.zeros(n_hits, dtype=np.int64)
+            n_hits = 0
+        for i in range(n):
+            min_tol_x = mzs[i] - (mzs[i] * 0.000001 * ppm)
+            max_tol_x = mzs[i] + (mzs[i] * 0.000001 * ppm)
+            for j in range(i + 1, n):
+                min_tol_y = mzs[j] - (mzs[j] * 0.000001 * ppm)
+                max_tol_y = mzs[j] + (mzs[j] * 0.000001 * ppm)
+                if min_tol_y - max_tol_x >= max_delta:
+                    break
+                for k in range(n_lib):
+                    min_tol_a = (min_tol_x - mass_a[k]) * charge_a[k]
+                    max_tol_a = (max_tol_x - mass_a[k]) * charge_a[k]
+                    min_tol_b = (min_tol_y - mass_b[k]) * charge_b[k]
+                    max_tol_b = (max_tol_y - mass_b[k]) * charge_b[k]
+                    if min_tol_a < max_tol_b and min_tol_b < max_tol_a:
+                        if p == 1:
+                            i_arr[n_hits] = i
+                            j_arr[n_hits] = j
+                            k_arr[n_hits] = k
+                        n_hits += 1
+    return i_arr, j_arr, k_arr
+
+
+if numba is not None:
+    _scan_pairs = numba.njit(cache=True)(_scan_pairs)
+
+
+def _scan_pairs_numpy(min_tols, max_tols, mass_a, mass_b, charge_a, charge_b, max_delta):
+    # NumPy fallback for _scan_pairs: one (window, libs) overlap test per
+    # row keeps memory at O(n * n_lib) rather than materializing the full
+    # (n, n, n_lib) cube, and emits hits in the same (i, j, k) order
+    n = min_tols.shape[0]
+    for i in range(n):
+        if np.isfinite(max_delta):
+            # same termination bound as the numba kernel: no j with
+            # min_tols[j] - max_tols[i] >= max_delta can match any entry
+            j_stop = np.searchsorted(min_tols, max_tols[i] + max_delta, side="left")
+        else:
+            j_stop = n
+        if j_stop <= i + 1:
+            continue
+        window = slice(i + 1, j_stop)
+        min_tol_a = (min_tols[i] - mass_a) * charge_a
+        max_tol_a = (max_tols[i] - mass_a) * charge_a
+        min_tol_b = (min_tols[window, None] - mass_b) * charge_b
+        max_tol_b = (max_tols[window, None] - mass_b) * charge_b
+        for dj, k in np.argwhere((min_tol_a < max_tol_b) & (min_tol_b < max_tol_a)):
+            yield i, i + 1 + dj, k
+
+
 def _annotate_pairs_from_graph(G, ppm, lib_pairs):
+    # yields (peak_id_a, peak_id_b, label_a, label_b, charge_a, charge_b, ppm_error)
 
-    for e in G.edges(data=True):
-        #if G.nodes[e[0]]["mz"] < G.nodes[e[1]]["mz"]:
-        #    mz_x = G.nodes[e[0]]["mz"]
-        #    mz_y = G.nodes[e[1]]["mz"]
-        #else:
-        mz_x = G.nodes[e[0]]["mz"]
-        mz_y = G.nodes[e[1]]["mz"]
-
-        for lib_pair in lib_pairs:
-            ct = _check_tolerance(mz_x, mz_y, lib_pair, ppm)
-            if ct == 1 or ct == True:
-
-                if "charge" in list(lib_pair.items())[0][1]:
-                    charge_a = list(lib_pair.items())[0][1]["charge"]
-                    charge_b = list(lib_pair.items())[1][1]["charge"]
-                else:
-                    charge_a = 1
-                    charge_b = 1
+    edges = list(G.edges())
+    if len(edges) == 0:
+        return
 
-                if "mass_difference" in lib_pair:
-                    ppm_error = calculate_ppm_error(
-                        mz_x,
-                        mz_y - lib_pair["mass_difference"])
-                else:
-                    ppm_error = calculate_ppm_error(
-                        (mz_x - list(lib_pair.items())[0][1]["mass"]) * charge_a,
-                        (mz_y - list(lib_pair.items())[1][1]["mass"]) * charge_b)
+    mz = nx.get_node_attributes(G, "mz")
+    mz_x = np.array([mz[e[0]] for e in edges], dtype=np.float64)
+    mz_y = np.array([mz[e[1]] for e in edges], dtype=np.float64)
+
+    mass_a, mass_b, charge_a, charge_b = _lib_pairs_to_arrays(lib_pairs)
+
+    min_tols_x, max_tols_x = calculate_mz_tolerance(mz_x, ppm)
+    min_tols_y, max_tols_y = calculate_mz_tolerance(mz_y, ppm)
+
+    # (edges, libs) overlap test in one broadcasted comparison
+    min_tol_a = (min_tols_x[:, None] - mass_a) * charge_a
+    max_tol_a = (max_tols_x[:, None] - mass_a) * charge_a
+    min_tol_b = (min_tols_y[:, None] - mass_b) * charge_b
+    max_tol_b = (max_tols_y[:, None] - mass_b) * charge_b
+
+    for e_idx, k in np.argwhere((min_tol_a < max_tol_b) & (min_tol_b < max_tol_a)):
 
-                yield OrderedDict([("peak_id_a", e[0]), ("peak_id_b", e[1]),
-                                   ("label_a", list(lib_pair.keys())[0]),
-                                   ("label_b", list(lib_pair.keys())[1]),
-                                   ('charge_a', charge_a),
-                                   ('charge_b', charge_b),
-                                   ('ppm_error', round(ppm_error, 2))])
+        e = edges[e_idx]
+        lib_pair = lib_pairs[k]
+
+        charge_a_out = lib_pair["charge_a"]
+        charge_b_out = lib_pair["charge_b"]
+
+        if lib_pair["has_diff"]:
+            ppm_error = calculate_ppm_error(
+                mz_x[e_idx],
+                mz_y[e_idx] - lib_pair["mass_diff"])
+        else:
+            ppm_error = calculate_ppm_error(
+                (mz_x[e_idx] - lib_pair["mass_a"]) * charge_a_out,
+                (mz_y[e_idx] - lib_pair["mass_b"]) * charge_b_out)
+
+        yield (e[0], e[1], lib_pair["label_a"], lib_pair["label_b"],
+               charge_a_out, charge_b_out, round(ppm_error, 2))
+
+
+def _subgraph_payload(graph):
+    # plain (nodes, edges) payload so subgraphs can be sent to worker processes
+    return list(graph.nodes(data=True)), list(graph.edges())
+
+
+def _annotate_subgraph(payload, ppm, lib_pairs):
+    nodes, edges = payload
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    return list(_annotate_pairs_from_graph(graph, ppm=ppm, lib_pairs=lib_pairs))
+
+
+def _assignments_from_graphs(graphs, ppm, lib_pairs, ncpus):
+    if ncpus is not None and ncpus > 1 and len(graphs) > 1:
+        with ProcessPoolExecutor(max_workers=ncpus) as executor:
+            results = list(executor.map(functools.partial(_annotate_subgraph, ppm=ppm, lib_pairs=lib_pairs),
+                                        [_subgraph_payload(graph) for graph in graphs]))
+        return itertools.chain.from_iterable(results)
+    return itertools.chain.from_iterable(_annotate_pairs_from_graph(graph, ppm=ppm, lib_pairs=lib_pairs)
+                                         for graph in graphs)
 
 
 def _annotate_pairs_from_peaklist(peaklist, ppm, lib_pairs):
-    n = len(peaklist.iloc[:,1])
-    for i in range(n):
-        for j in range(i + 1, n):
+    # yields (peak_id_a, peak_id_b, label_a, label_b, charge_a, charge_b, ppm_error)
+    if len(lib_pairs) == 0:  # e.g. a single-entry library yields no pairs
+        return
 
-            for lib_pair in lib_pairs:
-                ct = _check_tolerance(peaklist.iloc[i,1], peaklist.iloc[j,1], lib_pair, ppm)
+    ids = peaklist.iloc[:, 0].to_numpy()
+    mzs = peaklist.iloc[:, 1].to_numpy()
+    n = mzs.shape[0]
 
-                if ct == 1:
+    mass_a, mass_b, charge_a, charge_b = _lib_pairs_to_arrays(lib_pairs)
 
-                    if "charge" in list(lib_pair.items())[0][1]:
-                        charge_a = list(lib_pair.items())[0][1]["charge"]
-                        charge_b = list(lib_pair.items())[1][1]["charge"]
-                    else:
-                        charge_a = 1
-                        charge_b = 1
+    mzs_f8 = np.asarray(mzs, dtype=np.float64)
+    max_delta = _max_mz_delta(mzs_f8, mass_a, mass_b, charge_a, charge_b)
 
-                    if "mass_difference" in lib_pair:
-                        ppm_error = calculate_ppm_error(
-                            peaklist.iloc[i,1],
-                            peaklist.iloc[j,1] - lib_pair["mass_difference"])
+    if numba is not None:
+        hits = zip(*_scan_pairs(mzs_f8, mass_a, mass_b, charge_a, charge_b, ppm, max_delta))
+    else:
+        min_tols, max_tols = calculate_mz_tolerance(mzs_f8, ppm)
+        hits = _scan_pairs_numpy(min_tols, max_tols, mass_a, mass_b, charge_a, charge_b, max_delta)
 
-                    else:
-                        ppm_error = calculate_ppm_error(
-                            (peaklist.iloc[i,1] - list(lib_pair.items())[0][1]["mass"]) * list(lib_pair.items())[0][1]["charge"],
-                            (peaklist.iloc[j,1] - list(lib_pair.items())[1][1]["mass"]) * list(lib_pair.items())[1][1]["charge"])
+    for i, j, k in hits:
+
+        lib_pair = lib_pairs[k]
 
-                    yield OrderedDict([("peak_id_a", peaklist.iloc[i,0]), ("peak_id_b", peaklist.iloc[j,0]),
-                                       ("label_a", list(lib_pair.keys())[0]),
-                                       ("label_b", list(lib_pair.keys())[1]),
-                                       ('charge_a', charge_a),
-                                       ('charge_b', charge_b),
-                                       ('ppm_error', round(ppm_error,2))])
+        charge_a = lib_pair["charge_a"]
+        charge_b = lib_pair["charge_b"]
+
+        if lib_pair["has_diff"]:
+            ppm_error = calculate_ppm_error(
+                mzs[i],
+                mzs[j] - lib_pair["mass_diff"])
+
+        else:
+            ppm_error = calculate_ppm_error(
+                (mzs[i] - lib_pair["mass_a"]) * charge_a,
+                (mzs[j] - lib_pair["mass_b"]) * charge_b)
+
+        yield (ids[i], ids[j], lib_pair["label_a"], lib_pair["label_b"],
+               charge_a, charge_b, round(ppm_error, 2))
 
 
 class DbCompoundsMemory:
@@ -192,8 +350,7 @@ class DbCompoundsMemory:
     def __init__(self, filename):
 
         self.filename = filename
-        self.conn = sqlite3.connect(":memory:")
-        self.cursor = self.conn.cursor()
+        self.conn, self.cursor = _connect_results_db(":memory:")
         self.cursor.execute("""CREATE TABLE COMPOUNDS(
                             compound_id TEXT PRIMARY KEY  NOT NULL,
                             compound_name TEXT,
@@ -209,23 +366,21 @@ class DbCompoundsMemory:
                             );""")
 
         records = read_compounds(self.filename)
-        records = _remove_elements_from_compositions(records, keep=["C", "H", "N", "O", "P", "S"])
-        records = _flatten_composition(records)
-        for record in records:
-            columns = ",".join(map(str, list(record.keys())))
-            qms = ', '.join(['?'] * len(record.values()))
-            query = """insert into COMPOUNDS ({}) values ({})""".format(columns, qms)
-            self.cursor.execute(query, list(record.values()))
+        columns = ["compound_id", "compound_name", "exact_mass", "C", "H", "N", "O", "P", "S", "CHNOPS", "molecular_formula"]
+        _records_to_frame(records, columns).to_sql("COMPOUNDS", self.conn, if_exists="append", index=False)
 
         self.cursor.execute("""CREATE INDEX IDX_EXACT_MASS ON COMPOUNDS (exact_mass);""")
+        self.cursor.execute("ANALYZE COMPOUNDS")
         self.conn.commit()
 
+        self._col_names = ["compound_id", "compound_name", "exact_mass", "C", "H", "N", "O", "P", "S", "CHNOPS", "molecular_formula"]
+        self._sql_select = """SELECT {} FROM COMPOUNDS WHERE
+                           exact_mass >= ? and exact_mass <= ?
+                           """.format(",".join(map(str, self._col_names)))
+
     def select_compounds(self, min_tol, max_tol):
-        col_names = ["compound_id", "compound_name", "exact_mass", "C", "H", "N", "O", "P", "S", "CHNOPS", "molecular_formula"]
-        self.cursor.execute("""SELECT {} FROM COMPOUNDS WHERE 
-                            exact_mass >= {} and exact_mass <= {}
-                            """.format(",".join(map(str, col_names)), min_tol, max_tol))
-        return [OrderedDict(zip(col_names, list(record))) for record in self.cursor.fetchall()]
+        self.cursor.execute(self._sql_select, (min_tol, max_tol))
+        return [OrderedDict(zip(self._col_names, list(record))) for record in self.cursor.fetchall()]
 
     def close(self):
         self.conn.close()
@@ -236,8 +391,7 @@ class DbMolecularFormulaeMemory:
     def __init__(self, filename):
 
         self.filename = filename
-        self.conn = sqlite3.connect(":memory:")
-        self.cursor = self.conn.cursor()
+        self.conn, self.cursor = _connect_results_db(":memory:")
         self.cursor.execute("""CREATE TABLE MF(
                             exact_mass REAL,
                             C INTEGER DEFAULT 0,
@@ -256,40 +410,54 @@ class DbMolecularFormulaeMemory:
                             );""")
 
         records = read_molecular_formulae(self.filename)
-        records = _remove_elements_from_compositions(records, keep=["C", "H", "N", "O", "P", "S"])
-        records = _flatten_composition(records)
-        for record in records:
-            columns = ",".join(map(str, list(record.keys())))
-            qms = ', '.join(['?'] * len(record.values()))
-            query = """insert into mf ({}) values ({})""".format(columns, qms)
-            self.cursor.execute(query, list(record.values()))
+        columns = ["exact_mass", "C", "H", "N", "O", "P", "S", "CHNOPS",
+                   "HC", "NOPSC", "lewis", "senior", "double_bond_equivalents"]
+        _records_to_frame(records, columns).to_sql("MF", self.conn, if_exists="append", index=False)
 
         self.cursor.execute("""CREATE INDEX IDX_EXACT_MASS ON MF (exact_mass);""")
         self.cursor.execute("""CREATE INDEX IDX_EXACT_MASS_RULES ON MF (exact_mass, HC, NOPSC, LEWIS, SENIOR);""")
+        self.cursor.execute("ANALYZE MF")
         self.conn.commit()
 
+        self._col_names = ["exact_mass", "C", "H", "N", "O", "P", "S",
+                           "double_bond_equivalents", "LEWIS", "SENIOR", "HC", "NOPSC"]
+        self._sql_norules = """SELECT exact_mass, C, H, N, O, P, S,
+                            double_bond_equivalents, LEWIS, SENIOR, HC, NOPSC
+                            from mf where exact_mass >= ? and exact_mass <= ?
+                            """
+        self._sql_rules = self._sql_norules + " and lewis = 1 and senior = 1 and HC = 1 and NOPSC = 1"
+
     def select_mf(self, min_tol, max_tol, rules):
 
+        self.cursor.execute(self._sql_rules if rules else self._sql_norules, (min_tol, max_tol))
+
+        return [OrderedDict(zip(self._col_names, list(record))) for record in self.cursor.fetchall()]
+
+    def select_mf_ranges(self, names, mzs, min_tols, max_tols, rules):
+
         if rules:
             sql_filters = " and lewis = 1 and senior = 1 and HC = 1 and NOPSC = 1"
         else:
             sql_filters = ""
 
-        col_names = ["exact_mass", "C", "H", "N", "O", "P", "S",
-                     "double_bond_equivalents", "LEWIS", "SENIOR", "HC", "NOPSC"]
+        self.cursor.execute("DROP TABLE IF EXISTS peaks_range")
+        self.cursor.execute("""CREATE TEMP TABLE peaks_range (
+                            name TEXT, mz REAL, min_tol REAL, max_tol REAL);""")
+        self.cursor.executemany("""insert into peaks_range (name, mz, min_tol, max_tol) values (?,?,?,?)""",
+                                list(zip(names, mzs, min_tols, max_tols)))
 
-        self.cursor.execute("""SELECT exact_mass, C, H, N, O, P, S,
-                            double_bond_equivalents, LEWIS, SENIOR, HC, NOPSC
-                            from mf where exact_mass >= {} and exact_mass <= {}{}
-                            """.format(min_tol, max_tol, sql_filters))
+        self.cursor.execute("""SELECT p.name, p.mz, {} from peaks_range as p, mf
+                            where mf.exact_mass >= p.min_tol and mf.exact_mass <= p.max_tol{}
+                            ORDER BY p.rowid, mf.exact_mass, mf.rowid
+                            """.format(",".join(["mf.{}".format(c) for c in self._col_names]), sql_filters))
 
-        return [OrderedDict(zip(col_names, list(record))) for record in self.cursor.fetchall()]
+        return [(record[0], record[1], OrderedDict(zip(self._col_names, record[2:])))
+                for record in self.cursor.fetchall()]
 
 
-def annotate_adducts(source, db_out, ppm, lib, add=False):
+def annotate_adducts(source, db_out, ppm, lib, add=False, ncpus=None):
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     if not add:
         cursor.execute("DROP TABLE IF EXISTS adduct_pairs")
@@ -307,27 +475,34 @@ def annotate_adducts(source, db_out, ppm, lib, add=False):
     if isinstance(source, nx.classes.digraph.DiGraph):
         source = list(source.subgraph(c) for c in nx.weakly_connected_components(source))
 
+    sql = """INSERT OR REPLACE into adduct_pairs (peak_id_a, peak_id_b, label_a, label_b, ppm_error)
+          values (?,?,?,?,?)"""
+    rows = []
+
     if isinstance(source, list) and len(source) > 0 and isinstance(source[0], nx.classes.digraph.DiGraph):
-        for i, graph in enumerate(source):
-            for assignment in _annotate_pairs_from_graph(graph, lib_pairs=lib_pairs, ppm=ppm):
-                cursor.execute("""INSERT OR REPLACE into adduct_pairs (peak_id_a, peak_id_b, label_a, label_b, ppm_error)
-                               values (?,?,?,?,?)""", (str(assignment["peak_id_a"]), str(assignment["peak_id_b"]),
-                                                       assignment["label_a"], assignment["label_b"], float(assignment["ppm_error"])))
+        for peak_id_a, peak_id_b, label_a, label_b, _, _, ppm_error in _assignments_from_graphs(source, ppm, lib_pairs, ncpus):
+            rows.append((str(peak_id_a), str(peak_id_b), label_a, label_b, float(ppm_error)))
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
 
     elif isinstance(source, pd.core.frame.DataFrame):
-        for assignment in _annotate_pairs_from_peaklist(source, lib_pairs=lib_pairs, ppm=ppm):
-            cursor.execute("""INSERT OR REPLACE into adduct_pairs (peak_id_a, peak_id_b, label_a, label_b, ppm_error)
-                           values (?,?,?,?,?)""", (assignment["peak_id_a"], assignment["peak_id_b"],
-                                                   assignment["label_a"], assignment["label_b"], assignment["ppm_error"]))
+        for peak_id_a, peak_id_b, label_a, label_b, _, _, ppm_error in _annotate_pairs_from_peaklist(source, lib_pairs=lib_pairs, ppm=ppm):
+            rows.append((peak_id_a, peak_id_b, label_a, label_b, ppm_error))
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
+
+    if len(rows) > 0:
+        cursor.executemany(sql, rows)
     conn.commit()
     conn.close()
     return
 
 
-def annotate_isotopes(source, db_out, ppm, lib):
+def annotate_isotopes(source, db_out, ppm, lib, ncpus=None):
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     cursor.execute("DROP TABLE IF EXISTS isotopes")
 
@@ -342,164 +517,220 @@ def annotate_isotopes(source, db_out, ppm, lib):
 
     lib_pairs = _prep_lib(lib.lib)
 
-    abundances = {}
+    abundance = {}
     for pair in lib.lib:
-        abundances[list(pair.items())[0][0]] = list(pair.items())[0][1]
-        abundances[list(pair.items())[1][0]] = list(pair.items())[1][1]
+        (label_x, values_x), (label_y, values_y) = list(pair.items())[0:2]
+        abundance[label_x] = values_x["abundance"]
+        abundance[label_y] = values_y["abundance"]
 
     if isinstance(source, nx.classes.digraph.DiGraph):
         source = list(source.subgraph(c) for c in nx.weakly_connected_components(source))
 
-    if isinstance(source, list) and len(source) > 0 and isinstance(source[0], nx.classes.digraph.DiGraph):
+    sql = """insert into isotopes (peak_id_a, peak_id_b, label_a, label_b, atoms, ppm_error)
+          values (?,?,?,?,?,?)"""
+    rows = []
 
-        for graph in source:
+    if isinstance(source, list) and len(source) > 0 and isinstance(source[0], nx.classes.digraph.DiGraph):
 
-            peaklist = graph.nodes(data=True)
+        intensities = {n: attr["intensity"] for graph in source for n, attr in graph.nodes(data=True)}
 
-            for assignment in _annotate_pairs_from_graph(graph, lib_pairs=lib_pairs, ppm=ppm):
+        assignments = _assignments_from_graphs(source, ppm, lib_pairs, ncpus)
+        for batch in iter(lambda: list(itertools.islice(assignments, BATCH_SIZE)), []):
 
-                y = abundances[assignment["label_a"]]['abundance'] * peaklist[assignment["peak_id_b"]]["intensity"]
-                x = abundances[assignment["label_b"]]['abundance'] * peaklist[assignment["peak_id_a"]]["intensity"]
+            # the atoms arithmetic for a whole batch in four NumPy ops
+            # instead of per-assignment dict lookups and divisions
+            ab_a = np.array([abundance[a[2]] for a in batch])
+            ab_b = np.array([abundance[a[3]] for a in batch])
+            int_a = np.array([intensities[a[0]] for a in batch], dtype=np.float64)
+            int_b = np.array([intensities[a[1]] for a in batch], dtype=np.float64)
 
-                if x == 0.0 or y == 0.0:
-                    atoms = None
-                elif abundances[assignment["label_a"]]["abundance"] < abundances[assignment["label_b"]]["abundance"]:
-                    atoms = x / y
-                else:
-                    atoms = y/x
+            y = ab_a * int_b
+            x = ab_b * int_a
+            with np.errstate(divide="ignore", invalid="ignore"):
+                atoms = np.where(ab_a < ab_b, x / y, y / x)
+            atoms[(x == 0.0) | (y == 0.0)] = np.nan
 
-                cursor.execute("""insert into isotopes (peak_id_a, peak_id_b, label_a, label_b, atoms, ppm_error)
-                               values (?,?,?,?,?,?)""", (str(assignment["peak_id_a"]), str(assignment["peak_id_b"]),
-                               assignment["label_a"], assignment["label_b"], float(atoms), float(assignment["ppm_error"])))
+            for idx, (peak_id_a, peak_id_b, label_a, label_b, _, _, ppm_error) in enumerate(batch):
+                rows.append((str(peak_id_a), str(peak_id_b), label_a, label_b,
+                             float(atoms[idx]), float(ppm_error)))
+            cursor.executemany(sql, rows)
+            rows.clear()
 
     elif isinstance(source, pd.core.frame.DataFrame):
 
-        for assignment in _annotate_pairs_from_peaklist(source, lib_pairs=lib_pairs, ppm=ppm):
+        intensities = dict(zip(source["name"].to_numpy(), source["intensity"].to_numpy()))
+
+        for peak_id_a, peak_id_b, label_a, label_b, _, _, ppm_error in _annotate_pairs_from_peaklist(source, lib_pairs=lib_pairs, ppm=ppm):
 
-            y = abundances[assignment["label_a"]]["abundance"] * source.loc[source['name'] == assignment["peak_id_b"]]["intensity"].iloc[0]
-            x = abundances[assignment["label_b"]]["abundance"] * source.loc[source['name'] == assignment["peak_id_a"]]["intensity"].iloc[0]
+            y = abundance[label_a] * intensities[peak_id_b]
+            x = abundance[label_b] * intensities[peak_id_a]
 
             if x == 0.0 or y == 0.0:
                 atoms = None
-            elif abundances[assignment["label_a"]]["abundance"] < abundances[assignment["label_b"]]["abundance"]:
+            elif abundance[label_a] < abundance[label_b]:
                 atoms = x/y
             else:
                 atoms = y/x
 
-            cursor.execute("""insert into isotopes (peak_id_a, peak_id_b, label_a, label_b, atoms, ppm_error)
-                           values (?,?,?,?,?,?)""", (assignment["peak_id_a"], assignment["peak_id_b"],
-                           assignment["label_a"], assignment["label_b"], atoms, assignment["ppm_error"]))
-            conn.commit()
+            rows.append((peak_id_a, peak_id_b, label_a, label_b, atoms, ppm_error))
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
 
+    if len(rows) > 0:
+        cursor.executemany(sql, rows)
     conn.commit()
     conn.close()
     return
 
 
-def annotate_oligomers(source, db_out, ppm, lib, maximum=2):
+def _oligomer_rows_from_graph(graph, ppm, lib):
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    mz = nx.get_node_attributes(graph, "mz")
 
-    cursor.execute("DROP TABLE IF EXISTS oligomers")
+    for n in graph.nodes():
 
-    cursor.execute("""CREATE TABLE oligomers (
-                   peak_id_a INTEGER DEFAULT NULL,
-                   peak_id_b INTEGER DEFAULT NULL,
-                   mz_a REAL DEFAULT NULL,
-                   mz_b REAL DEFAULT NULL,
-                   label_a TEXT DEFAULT NULL,
-                   label_b TEXT DEFAULT NULL,
-                   mz_ratio REAL DEFAULT NULL,
-                   ppm_error REAL DEFAULT NULL,
-                   PRIMARY KEY (peak_id_a, peak_id_b));""")
+        neighbors = list(graph.neighbors(n))
+        mz_x = mz[n]
 
-    if isinstance(source, nx.classes.digraph.DiGraph):
-        source = list(source.subgraph(c) for c in nx.weakly_connected_components(source))
+        for d in range(1, len(neighbors)+1):
 
-    if isinstance(source, list) and len(source) > 0 and isinstance(source[0], nx.classes.digraph.DiGraph):
+            for nn in neighbors:
 
-        for graph in source:
+                mz_y = mz[nn]
 
-            for n in graph.nodes():
+                if mz_x < mz_y:
 
-                neighbors = list(graph.neighbors(n))
+                    for adduct, shift in lib.lib.items():
 
-                for d in range(1, len(neighbors)+1):
+                        min_tol_a, max_tol_a = calculate_mz_tolerance(mz_x + ((mz_x - shift) * d), ppm)
+                        min_tol_b, max_tol_b = calculate_mz_tolerance(mz_y, ppm)
 
-                    for nn in neighbors:
+                        if (min_tol_b > max_tol_a and max_tol_b > max_tol_a):# or (min_tol_a < min_tol_b and max_tol_a < min_tol_b):
+                            #print(source.iloc[i][1], source.iloc[j][1], adduct)
+                            break
 
-                        mz_x = graph.nodes[n]["mz"]
-                        mz_y = graph.nodes[nn]["mz"]
+                        min_tol_a = min_tol_a - shift
+                        max_tol_a = max_tol_a - shift
 
-                        if mz_x < mz_y:
+                        min_tol_b = min_tol_b - shift
+                        max_tol_b = max_tol_b - shift
 
-                            for adduct in lib.lib.keys():
+                        if min_tol_a < max_tol_b and min_tol_b < max_tol_a:
 
-                                min_tol_a, max_tol_a = calculate_mz_tolerance(mz_x + ((mz_x - lib.lib[adduct]) * d), ppm)
-                                min_tol_b, max_tol_b = calculate_mz_tolerance(mz_y, ppm)
+                            a = (mz_x - shift) + (mz_x - shift) * d
+                            b = mz_y - shift
 
-                                if (min_tol_b > max_tol_a and max_tol_b > max_tol_a):# or (min_tol_a < min_tol_b and max_tol_a < min_tol_b):
-                                    #print(source.iloc[i][1], source.iloc[j][1], adduct)
-                                    break
+                            ratio = (mz_y - shift) / (mz_x - shift)
+                            ppm_error = calculate_ppm_error(a, b)
 
-                                min_tol_a = min_tol_a - lib.lib[adduct]
-                                max_tol_a = max_tol_a - lib.lib[adduct]
+                            if "M" in adduct:
+                                adduct_oligo = adduct.replace("M", "{}M".format(int(round(ratio))))
+                            else:
+                                adduct_oligo = "{}{}".format(int(round(ratio)), adduct)
 
-                                min_tol_b = min_tol_b - lib.lib[adduct]
-                                max_tol_b = max_tol_b - lib.lib[adduct]
+                            yield (n, nn, mz_x, mz_y, adduct, adduct_oligo, round(ratio, 2), round(ppm_error, 2))
 
-                                if min_tol_a < max_tol_b and min_tol_b < max_tol_a:
 
-                                    a = (mz_x - lib.lib[adduct]) + (mz_x - lib.lib[adduct]) * d
-                                    b = mz_y - lib.lib[adduct]
+def _annotate_oligomers_subgraph(payload, ppm, lib):
+    nodes, edges = payload
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    return list(_oligomer_rows_from_graph(graph, ppm=ppm, lib=lib))
 
-                                    ratio = (mz_y - lib.lib[adduct]) / (mz_x - lib.lib[adduct])
-                                    ppm_error =calculate_ppm_error(a, b)
 
-                                    if "M" in adduct:
-                                        adduct_oligo = adduct.replace("M", "{}M".format(int(round(ratio))))
-                                    else:
-                                        adduct_oligo = "{}{}".format(int(round(ratio)), adduct)
+def annotate_oligomers(source, db_out, ppm, lib, maximum=2, ncpus=None):
 
-                                    cursor.execute("""insert into oligomers (peak_id_a, peak_id_b, mz_a, mz_b, label_a, label_b, mz_ratio, ppm_error)
-                                                   values (?,?,?,?,?,?,?,?)""", (n, nn, mz_x, mz_y, adduct, adduct_oligo, round(ratio, 2), round(ppm_error, 2)))
+    conn, cursor = _connect_results_db(db_out)
 
-    elif isinstance(source, pd.core.frame.DataFrame):
+    cursor.execute("DROP TABLE IF EXISTS oligomers")
 
-        n = len(source.iloc[:,0])
-        for adduct in lib.lib.keys():
-            for i in range(n):
-                for d in range(1, maximum):
-                    for j in range(i + 1, n):
+    cursor.execute("""CREATE TABLE oligomers (
+                   peak_id_a INTEGER DEFAULT NULL,
+                   peak_id_b INTEGER DEFAULT NULL,
+                   mz_a REAL DEFAULT NULL,
+                   mz_b REAL DEFAULT NULL,
+                   label_a TEXT DEFAULT NULL,
+                   label_b TEXT DEFAULT NULL,
+                   mz_ratio REAL DEFAULT NULL,
+                   ppm_error REAL DEFAULT NULL,
+                   PRIMARY KEY (peak_id_a, peak_id_b));""")
 
-                        min_tol_a, max_tol_a = calculate_mz_tolerance(source.iloc[i][1] + ((source.iloc[i][1] - lib.lib[adduct]) * d), ppm)
-                        min_tol_b, max_tol_b = calculate_mz_tolerance(source.iloc[j][1], ppm)
+    if isinstance(source, nx.classes.digraph.DiGraph):
+        source = list(source.subgraph(c) for c in nx.weakly_connected_components(source))
 
-                        if (min_tol_b > max_tol_a and max_tol_b > max_tol_a):# or (min_tol_a < min_tol_b and max_tol_a < min_tol_b):
-                            #print(source.iloc[i][1], source.iloc[j][1], adduct)
-                            break
+    sql = """insert into oligomers (peak_id_a, peak_id_b, mz_a, mz_b, label_a, label_b, mz_ratio, ppm_error)
+          values (?,?,?,?,?,?,?,?)"""
+    rows = []
 
-                        min_tol_a = min_tol_a - lib.lib[adduct]
-                        max_tol_a = max_tol_a - lib.lib[adduct]
+    if isinstance(source, list) and len(source) > 0 and isinstance(source[0], nx.classes.digraph.DiGraph):
 
-                        min_tol_b = min_tol_b - lib.lib[adduct]
-                        max_tol_b = max_tol_b - lib.lib[adduct]
+        if ncpus is not None and ncpus > 1 and len(source) > 1:
+            with ProcessPoolExecutor(max_workers=ncpus) as executor:
+                results = list(executor.map(functools.partial(_annotate_oligomers_subgraph, ppm=ppm, lib=lib),
+                                            [_subgraph_payload(graph) for graph in source]))
+            oligomer_rows = itertools.chain.from_iterable(results)
+        else:
+            oligomer_rows = itertools.chain.from_iterable(_oligomer_rows_from_graph(graph, ppm=ppm, lib=lib)
+                                                          for graph in source)
 
-                        if min_tol_a < max_tol_b and min_tol_b < max_tol_a:
+        for row in oligomer_rows:
+            rows.append(row)
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
 
-                            a = (source.iloc[i][1] - lib.lib[adduct]) + (source.iloc[i][1] - lib.lib[adduct]) * d
-                            b = source.iloc[j][1] - lib.lib[adduct]
+    elif isinstance(source, pd.core.frame.DataFrame):
 
-                            ratio = (source.iloc[j][1] - lib.lib[adduct]) / (source.iloc[i][1] - lib.lib[adduct])
-                            ppm_error = calculate_ppm_error(a, b)
+        ids = source.iloc[:, 0].to_numpy()
+        mzs = source.iloc[:, 1].to_numpy()
+        n = mzs.shape[0]
 
-                            if "M" in adduct:
-                                adduct_oligo = adduct.replace("M", "{}M".format(int(round(ratio))))
-                            else:
-                                adduct_oligo = "{}{}".format(int(round(ratio)), adduct)
-                            cursor.execute("""insert into oligomers (peak_id_a, peak_id_b, mz_a, mz_b, label_a, label_b, mz_ratio, ppm_error)
-                                           values (?,?,?,?,?,?,?,?)""", (source.iloc[i][0], source.iloc[j][0], source.iloc[i][1], source.iloc[j][1], adduct, adduct_oligo, round(ratio, 2), round(ppm_error, 2)))
+        # per-peak ppm windows; the adduct shift cancels out of the overlap
+        # test so the candidate js for an oligomer target can be found with
+        # one vectorized comparison per (peak, d), or, when the peaklist is
+        # sorted by mz, by bracketing the target window with searchsorted
+        min_tols_b, max_tols_b = calculate_mz_tolerance(mzs, ppm)
+        mzs_ascending = bool(np.all(np.diff(mzs) >= 0.0))
+
+        for adduct, shift in lib.lib.items():
+
+            # tolerance windows for every oligomer target in one vectorized
+            # call per d instead of one scalar call per (peak, d)
+            tols_a = [calculate_mz_tolerance(mzs + ((mzs - shift) * d), ppm) for d in range(1, maximum)]
+
+            for i in range(n):
+                for d in range(1, maximum):
+
+                    min_tol_a, max_tol_a = tols_a[d - 1][0][i], tols_a[d - 1][1][i]
+
+                    if mzs_ascending:
+                        left = np.searchsorted(max_tols_b, min_tol_a, side="right")
+                        right = np.searchsorted(min_tols_b, max_tol_a, side="left")
+                        candidates = np.arange(max(left, i + 1), right)
+                    else:
+                        candidates = np.flatnonzero((max_tols_b > min_tol_a) & (min_tols_b < max_tol_a))
+                        candidates = candidates[candidates > i]
+                    for j in candidates:
+
+                        a = (mzs[i] - shift) + (mzs[i] - shift) * d
+                        b = mzs[j] - shift
+
+                        ratio = (mzs[j] - shift) / (mzs[i] - shift)
+                        ppm_error = calculate_ppm_error(a, b)
+
+                        if "M" in adduct:
+                            adduct_oligo = adduct.replace("M", "{}M".format(int(round(ratio))))
+                        else:
+                            adduct_oligo = "{}{}".format(int(round(ratio)), adduct)
+                        rows.append((ids[i], ids[j], mzs[i], mzs[j], adduct, adduct_oligo, round(ratio, 2), round(ppm_error, 2)))
+                        if len(rows) == BATCH_SIZE:
+                            cursor.executemany(sql, rows)
+                            rows.clear()
+
+    if len(rows) > 0:
+        cursor.executemany(sql, rows)
     conn.commit()
     conn.close()
     return
@@ -507,8 +738,7 @@ def annotate_oligomers(source, db_out, ppm, lib, maximum=2):
 
 def annotate_artifacts(source, db_out, diff):
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     cursor.execute("DROP TABLE IF EXISTS artifacts")
 
@@ -522,26 +752,38 @@ def annotate_artifacts(source, db_out, diff):
     if isinstance(source, nx.classes.digraph.DiGraph):
         source = list(source.subgraph(c) for c in nx.weakly_connected_components(source))
 
+    sql = """insert into artifacts (peak_id_a, peak_id_b, mz_diff, ppm_error)
+          values (?,?,?,?)"""
+    rows = []
+
     if (isinstance(source, list) or isinstance(source, np.ndarray)) and isinstance(source[0], nx.classes.graph.Graph):
         for graph in source:
-            peaklist = graph.nodes(data=True)
-            for assignment in _annotate_artifacts(peaklist, diff=diff):
-                cursor.execute("""insert into artifacts (peak_id_a, peak_id_b, mz_diff, ppm_error)
-                               values (?,?,?,?)""", (assignment["peak_id_a"], assignment["peak_id_b"], assignment["label_a"], assignment["label_b"]))
+            ids = np.array([n for n in graph.nodes()], dtype=object)
+            mzs = np.array([graph.nodes[n]["mz"] for n in graph.nodes()])
+            for peak_id_a, peak_id_b, mz_diff, ppm_error in _annotate_artifacts(mzs, ids, diff=diff):
+                rows.append((peak_id_a, peak_id_b, mz_diff, round(ppm_error, 2)))
+                if len(rows) == BATCH_SIZE:
+                    cursor.executemany(sql, rows)
+                    rows.clear()
 
     elif isinstance(source, pd.core.frame.DataFrame):
-        for assignment in _annotate_artifacts(source, diff=diff):
-            cursor.execute("""insert into artifacts (peak_id_a, peak_id_b, mz_diff, ppm_error)
-                           values (?,?,?,?)""", (assignment["peak_id_a"], assignment["peak_id_b"], assignment["label_a"], assignment["label_b"]))
-
+        ids = source.iloc[:, 0].to_numpy()
+        mzs = source.iloc[:, 1].to_numpy()
+        for peak_id_a, peak_id_b, mz_diff, ppm_error in _annotate_artifacts(mzs, ids, diff=diff):
+            rows.append((peak_id_a, peak_id_b, mz_diff, round(ppm_error, 2)))
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
+
+    if len(rows) > 0:
+        cursor.executemany(sql, rows)
     conn.commit()
     return
 
 
-def annotate_multiple_charged_ions(source, db_out, ppm, lib, add=False):
+def annotate_multiple_charged_ions(source, db_out, ppm, lib, add=False, ncpus=None):
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     if not add:
         cursor.execute("DROP TABLE IF EXISTS multiple_charged_ions")
@@ -561,18 +803,26 @@ def annotate_multiple_charged_ions(source, db_out, ppm, lib, add=False):
     if isinstance(source, nx.classes.digraph.DiGraph):
         source = list(source.subgraph(c) for c in nx.weakly_connected_components(source))
 
+    sql = """INSERT OR REPLACE into multiple_charged_ions (peak_id_a, peak_id_b, label_a, label_b, charge_a, charge_b, ppm_error)
+          values (?,?,?,?,?,?,?)"""
+    rows = []
+
     if (isinstance(source, list) or isinstance(source, np.ndarray)) and isinstance(source[0], nx.classes.graph.Graph):
-        for graph in source:
-            for assignment in _annotate_pairs_from_graph(graph, lib_pairs=lib_pairs, ppm=ppm):
-                cursor.execute("""INSERT OR REPLACE into multiple_charged_ions (peak_id_a, peak_id_b, label_a, label_b, charge_a, charge_b, ppm_error)
-                               values (?,?,?,?,?,?,?)""", (assignment["peak_id_a"], assignment["peak_id_b"], assignment["label_a"], assignment["label_b"],
-                                                           assignment["charge_a"], assignment["charge_b"], assignment["ppm_error"]))
+        for assignment in _assignments_from_graphs(list(source), ppm, lib_pairs, ncpus):
+            rows.append(assignment)
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
 
     elif isinstance(source, pd.core.frame.DataFrame):
         for assignment in _annotate_pairs_from_peaklist(source, lib_pairs=lib_pairs, ppm=ppm):
-            cursor.execute("""INSERT OR REPLACE into multiple_charged_ions (peak_id_a, peak_id_b, label_a, label_b, charge_a, charge_b, ppm_error)
-                           values (?,?,?,?,?,?,?)""", (assignment["peak_id_a"], assignment["peak_id_b"],
-                                                       assignment["label_a"], assignment["label_b"], assignment["charge_a"], assignment["charge_b"], assignment["ppm_error"]))
+            rows.append(assignment)
+            if len(rows) == BATCH_SIZE:
+                cursor.executemany(sql, rows)
+                rows.clear()
+
+    if len(rows) > 0:
+        cursor.executemany(sql, rows)
     conn.commit()
     conn.close()
     return
@@ -580,8 +830,7 @@ def annotate_multiple_charged_ions(source, db_out, ppm, lib, add=False):
 
 def annotate_molecular_formulae(peaklist, lib_adducts, ppm, db_out, db_in="http://mfdb.bham.ac.uk", rules=True, max_mz=None):
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     cursor.execute("DROP TABLE IF EXISTS molecular_formulae")
 
@@ -617,58 +866,109 @@ def annotate_molecular_formulae(peaklist, lib_adducts, ppm, db_out, db_in="http:
         if o.scheme != "http" and o.netloc != "mfdb.bham.ac.uk":
             raise ValueError("No database or local db available")
         else:
-            r = requests.get(url_test)
+            session = requests.Session()
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+            r = session.get(url_test)
             r.raise_for_status()
 
-    path_nist_database = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nist_database.txt')
-    nist_database = nist_database_to_pyteomics(path_nist_database)
-
-    for i in range(len(peaklist.iloc[:, 0])):
-        mz = float(peaklist["mz"].iloc[i])
-        name = str(peaklist["name"].iloc[i])
-
-        min_tol, max_tol = calculate_mz_tolerance(mz, ppm)
-
-        if max_mz is not None and mz > max_mz:  # TODO
-            continue
+        @functools.lru_cache(maxsize=None)
+        def _fetch_records(lower, upper):
+            # neighbouring peaks and adducts produce overlapping mass ranges,
+            # so memoize per range; the session reuses the TCP connection
+            response = session.get(url, params={"lower": lower, "upper": upper, "rules": int(rules)})
+            return response.json()["records"]
 
-        values = []
-        for adduct in lib_adducts.lib:
-
-            if mz - lib_adducts.lib[adduct] > 0.5:
-
-                if "conn_mem" in locals():
-                    records = conn_mem.select_mf(min_tol - lib_adducts.lib[adduct], max_tol - lib_adducts.lib[adduct], rules)
-                else:
-                    params = {"lower": min_tol - lib_adducts.lib[adduct],
-                              "upper": max_tol - lib_adducts.lib[adduct],
-                              "rules": int(rules)}
-                    response = requests.get(url, params=params)
-                    records = response.json()["records"]
-
-                for record in records:
-                    record["id"] = name
-                    if "CHNOPS" not in record:  # MFdb API specific
-                        record["CHNOPS"] = True  # MFdb API specific
-                    if "rules" in record:
-                        record.update(record["rules"])
-                        del record["rules"]
-                    if "atoms" in record:
-                        record.update(record["atoms"])
-                        del record["atoms"]
-                    record["exact_mass"] = record["exact_mass"] + lib_adducts.lib[adduct]
-                    record["mz"] = mz
-                    record["ppm_error"] = calculate_ppm_error(mz, record["exact_mass"])
-                    comp = OrderedDict([(item, record[item]) for item in record if item in nist_database.keys()])
-                    record["molecular_formula"] = composition_to_string(comp)
-                    record["adduct"] = adduct
-                records = _remove_elements_from_compositions(records, keep=["C", "H", "N", "O", "P", "S"])
-                values.extend([list(record.values()) for record in records])
-
-        time.sleep(0.02)
+    path_nist_database = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nist_database.txt')
+    nist_database = _nist_database(path_nist_database)
+    nist_symbols = frozenset(nist_database)
+
+    mzs = peaklist["mz"].to_numpy()
+    names = peaklist["name"].to_numpy()
+
+    if "conn_mem" in locals():
+
+        # one ranged join per adduct instead of one query per (peak, adduct);
+        # values are regrouped per peak to keep the original insertion order
+        min_tols, max_tols = calculate_mz_tolerance(mzs, ppm)
+        values_by_peak = OrderedDict((str(name), []) for name in names)
+
+        for adduct, shift in lib_adducts.lib.items():
+
+            sel = mzs - shift > 0.5
+
+            records = []
+            for name, mz, record in conn_mem.select_mf_ranges(names[sel], mzs[sel],
+                                                              min_tols[sel] - shift, max_tols[sel] - shift, rules):
+                record["id"] = name
+                record["CHNOPS"] = True
+                record["exact_mass"] = record["exact_mass"] + shift
+                record["mz"] = mz
+                record["ppm_error"] = calculate_ppm_error(mz, record["exact_mass"])
+                comp = OrderedDict([(item, record[item]) for item in record if item in nist_symbols])
+                record["molecular_formula"] = composition_to_string(comp)
+                record["adduct"] = adduct
+                # the MF table only carries CHNOPS columns, so no element
+                # filtering is needed here
+                records.append(record)
+
+            for record in records:
+                values_by_peak[record["id"]].append(list(record.values()))
+
+        values = [vs for peak_values in values_by_peak.values() for vs in peak_values]
         if len(values) > 0:
             cursor.executemany("""insert into molecular_formulae ({}) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
                                """.format(",".join(map(str, list(record.keys())))), values)
+
+    else:
+
+        sql_insert = None
+        adduct_shifts = list(lib_adducts.lib.items())
+
+        # numpy scalars subclass float/str, so they feed the arithmetic and
+        # the SQLite bindings directly without per-row coercions
+        for name, mz in zip(names, mzs):
+
+            min_tol, max_tol = calculate_mz_tolerance(mz, ppm)
+
+            if max_mz is not None and mz > max_mz:  # TODO
+                continue
+
+            values = []
+            for adduct, shift in adduct_shifts:
+
+                if mz - shift > 0.5:
+
+                    # copy the cached records as they are modified in place below
+                    records = [dict(record) for record in
+                               _fetch_records(min_tol - shift, max_tol - shift)]
+
+                    for record in records:
+                        record["id"] = name
+                        if "CHNOPS" not in record:  # MFdb API specific
+                            record["CHNOPS"] = True  # MFdb API specific
+                        if "rules" in record:
+                            record.update(record["rules"])
+                            del record["rules"]
+                        if "atoms" in record:
+                            record.update(record["atoms"])
+                            del record["atoms"]
+                        record["exact_mass"] = record["exact_mass"] + shift
+                        record["mz"] = mz
+                        record["ppm_error"] = calculate_ppm_error(mz, record["exact_mass"])
+                        comp = OrderedDict([(item, record[item]) for item in record if item in nist_symbols])
+                        record["molecular_formula"] = composition_to_string(comp)
+                        record["adduct"] = adduct
+                        for e in comp:  # emit records restricted to CHNOPS
+                            if e not in _CHNOPS:
+                                del record[e]
+                    if len(records) > 0 and sql_insert is None:
+                        sql_insert = """insert into molecular_formulae ({}) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                                     """.format(",".join(map(str, list(records[0].keys()))))
+                    values.extend([list(record.values()) for record in records])
+
+            time.sleep(0.02)
+            if len(values) > 0:
+                cursor.executemany(sql_insert, values)
     conn.commit()
     conn.close()
     return
@@ -682,19 +982,51 @@ def annotate_compounds(peaklist, lib_adducts, ppm, db_out, db_name, db_in=""):
         for db_local in os.listdir(path_dbs):
             if db_name == db_local.replace(".sql.gz", ""):
 
-                with gzip.GzipFile(os.path.join(path_dbs, db_local), mode='rb') as db_dump:
+                path_gz = os.path.join(path_dbs, db_local)
+                path_cache = os.path.join(path_dbs, db_name + ".sqlite")
 
-                    conn_local = sqlite3.connect(":memory:")
+                # the decompressed database is persisted next to the dump so
+                # later runs open it directly instead of re-parsing the SQL
+                if os.path.isfile(path_cache) and os.path.getmtime(path_cache) >= os.path.getmtime(path_gz):
+                    conn_local = sqlite3.connect(path_cache, uri=True)
                     cursor_local = conn_local.cursor()
-                    cursor_local.executescript(db_dump.read().decode('utf-8'))
+                else:
+                    # drop temp files left behind by interrupted builds; a
+                    # unique suffix below keeps concurrent first runs (and a
+                    # stale or corrupt leftover) from colliding with ours
+                    for fn_stale in os.listdir(path_dbs):
+                        if fn_stale.startswith(db_name + ".sqlite.") and fn_stale.endswith(".tmp"):
+                            try:
+                                os.remove(os.path.join(path_dbs, fn_stale))
+                            except OSError:
+                                pass
+
+                    path_tmp = None
+                    try:
+                        path_tmp = "{}.{}.tmp".format(path_cache, uuid.uuid4().hex)
+                        conn_local, cursor_local = _connect_results_db(path_tmp)
+                    except sqlite3.OperationalError:  # data directory not writable
+                        path_tmp = None
+                        conn_local, cursor_local = _connect_results_db(":memory:")
+
+                    with gzip.open(path_gz, mode="rt", encoding="utf-8") as db_dump:
+                        cursor_local.executescript(db_dump.read())
                     conn_local.commit()
 
-                    cursor_local.execute("CREATE INDEX idx_exact_mass ON {} (exact_mass)".format(db_name.replace(".sql.gz", "")))
+                    cursor_local.execute("CREATE INDEX idx_exact_mass ON {} (exact_mass)".format(db_name))
+                    cursor_local.execute("ANALYZE {}".format(db_name))
 
-                    cursor_local.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                    if (db_name.replace(".sql.gz", ""), ) not in cursor_local.fetchall():
-                        raise ValueError("Database {} not available".format(db_name))
-                    break
+                    if path_tmp is not None:
+                        conn_local.commit()
+                        conn_local.close()
+                        os.replace(path_tmp, path_cache)
+                        conn_local = sqlite3.connect(path_cache, uri=True)
+                        cursor_local = conn_local.cursor()
+
+                cursor_local.execute("SELECT name FROM sqlite_master WHERE type='table'")
+                if (db_name, ) not in cursor_local.fetchall():
+                    raise ValueError("Database {} not available".format(db_name))
+                break
 
         if conn_local is None:
             raise ValueError("Database {} not available".format(db_name))
@@ -702,7 +1034,7 @@ def annotate_compounds(peaklist, lib_adducts, ppm, db_out, db_name, db_in=""):
     elif os.path.isfile(db_in):
         with open(db_in, 'rb') as fd:
             if fd.read(100)[:16].decode() == 'SQLite format 3\x00':
-                conn_local = sqlite3.connect(db_in)
+                conn_local = sqlite3.connect(db_in, uri=True)
                 cursor_local = conn_local.cursor()
                 cursor_local.execute("SELECT name FROM sqlite_master WHERE type='table'")
                 if not (db_name, ) in cursor_local.fetchall():
@@ -712,8 +1044,7 @@ def annotate_compounds(peaklist, lib_adducts, ppm, db_out, db_name, db_in=""):
     else:
         raise IOError("[Errno 2] No such file or directory: {}".format(db_in))
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     cursor.execute("DROP TABLE IF EXISTS compounds_{}".format(db_name))
     cursor.execute("""CREATE TABLE compounds_{} (
@@ -735,38 +1066,60 @@ def annotate_compounds(peaklist, lib_adducts, ppm, db_out, db_name, db_in=""):
                    primary key (id, compound_id, adduct)
                    );""".format(db_name))
 
-    for i in range(len(peaklist.iloc[:, 0])):
-        mz = float(peaklist["mz"].iloc[i])
-        name = str(peaklist["name"].iloc[i])
-        min_tol, max_tol = calculate_mz_tolerance(mz, ppm)
-
-        for adduct in lib_adducts.lib:
-
-            if mz - lib_adducts.lib[adduct] > 0.5:
-
-                if "conn_mem" in locals():
-                    records = conn_mem.select_compounds(min_tol - lib_adducts.lib[adduct], max_tol - lib_adducts.lib[adduct])
-                elif "conn_local" in locals():
-                    col_names = ["compound_id", "C", "H", "N", "O", "P", "S", "CHNOPS", "molecular_formula", "compound_name", "exact_mass"]
-                    cursor_local.execute("""SELECT id, C, H, N, O, P, S, CHNOPS,
-                                            molecular_formula, name, exact_mass
-                                            from {} where exact_mass >= {} and exact_mass <= {}
-                                            """.format(db_name, min_tol - lib_adducts.lib[adduct], max_tol - lib_adducts.lib[adduct]))
-                    records = [OrderedDict(zip(col_names, list(record))) for record in cursor_local.fetchall()]
-
-                for record in records:
-                    record["id"] = name
-                    record["exact_mass"] = record["exact_mass"] + float(lib_adducts.lib[adduct])
-                    record["mz"] = mz
-                    record["ppm_error"] = calculate_ppm_error(mz, record["exact_mass"])
-                    record["adduct"] = adduct
-                    cursor.execute("""insert into compounds_{} ({}) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                                   """.format(db_name, ",".join(map(str, list(record.keys())))), list(record.values()))
+    conn.commit()
+
+    mzs = peaklist["mz"].to_numpy(dtype=np.float64)
+    names = peaklist["name"].to_numpy()
+    min_tols, max_tols = calculate_mz_tolerance(mzs, ppm)
+
+    if "conn_mem" in locals():
+        conn_src, cursor_src = conn_mem.conn, conn_mem.cursor
+        table_src = "COMPOUNDS"
+        columns_out = "compound_id, compound_name, exact_mass, C, H, N, O, P, S, CHNOPS, molecular_formula, id, mz, ppm_error, adduct"
+        columns_src = "d.compound_id, d.compound_name, d.exact_mass + a.shift, d.C, d.H, d.N, d.O, d.P, d.S, d.CHNOPS, d.molecular_formula"
+    else:
+        conn_src, cursor_src = conn_local, cursor_local
+        table_src = db_name
+        columns_out = "compound_id, C, H, N, O, P, S, CHNOPS, molecular_formula, compound_name, exact_mass, id, mz, ppm_error, adduct"
+        columns_src = "d.id, d.C, d.H, d.N, d.O, d.P, d.S, d.CHNOPS, d.molecular_formula, d.name, d.exact_mass + a.shift"
+
+    # the results database is attached to the compound database so the whole
+    # annotation runs as one INSERT ... SELECT and records never round-trip
+    # through Python; ordered per peak, then adduct, then exact mass, which
+    # matches the insertion order of the per-peak queries this replaces
+    cursor_src.execute("ATTACH DATABASE ? AS results", (db_out,))
+
+    cursor_src.execute("DROP TABLE IF EXISTS peaks_range")
+    cursor_src.execute("""CREATE TEMP TABLE peaks_range (
+                       name TEXT, mz REAL, min_tol REAL, max_tol REAL);""")
+    cursor_src.executemany("""insert into peaks_range (name, mz, min_tol, max_tol) values (?,?,?,?)""",
+                           list(zip(names, mzs, min_tols, max_tols)))
+
+    cursor_src.execute("DROP TABLE IF EXISTS lib_adducts_tmp")
+    cursor_src.execute("CREATE TEMP TABLE lib_adducts_tmp (adduct TEXT, shift REAL)")
+    cursor_src.executemany("insert into lib_adducts_tmp (adduct, shift) values (?,?)",
+                           list(lib_adducts.lib.items()))
+
+    cursor_src.execute("""INSERT INTO results.compounds_{} ({})
+                       SELECT {},
+                       p.name, p.mz,
+                       (d.exact_mass + a.shift - p.mz) / ((d.exact_mass + a.shift) * 0.000001),
+                       a.adduct
+                       from peaks_range as p, lib_adducts_tmp as a, {} as d
+                       where p.mz - a.shift > 0.5
+                       and d.exact_mass >= p.min_tol - a.shift
+                       and d.exact_mass <= p.max_tol - a.shift
+                       ORDER BY p.rowid, a.rowid, d.exact_mass, d.rowid
+                       """.format(db_name, columns_out, columns_src, table_src))
+    conn_src.commit()
+    cursor_src.execute("DETACH DATABASE results")
+
     conn.commit()
     conn.close()
     return
 
 
+@functools.lru_cache(maxsize=None)
 def predict_drug_products(smiles, phase1_cycles, phase2_cycles):
 
     try:
@@ -794,8 +1147,7 @@ def predict_drug_products(smiles, phase1_cycles, phase2_cycles):
 class DbDrugCompoundsMemory:
 
     def __init__(self):
-        self.conn = sqlite3.connect(":memory:")
-        self.cursor = self.conn.cursor()
+        self.conn, self.cursor = _connect_results_db(":memory:")
         self.cursor.execute("""CREATE TABLE predicted_drug_products (
                             compound_id TEXT PRIMARY KEY  NOT NULL,
                             compound_name TEXT,
@@ -814,29 +1166,81 @@ class DbDrugCompoundsMemory:
                             parent TEXT
                             );""")
 
-        self.cursor.execute("""CREATE INDEX IDX_EXACT_MASS ON predicted_drug_products (exact_mass);""")
+        # covering index: the range scans on exact_mass read every column
+        # from the index without a row lookup
+        self.cursor.execute("""CREATE INDEX IDX_EXACT_MASS ON predicted_drug_products
+                            (exact_mass, compound_id, compound_name, smiles, sygma_score,
+                            sygma_pathway, parent, C, H, N, O, P, S, CHNOPS, molecular_formula);""")
+        self.cursor.execute("ANALYZE predicted_drug_products")
         self.conn.commit()
 
     def insert(self, records):
+        # all records share one key order, so the statement is built once
+        # and the rows go in as a single batch
+        sql_insert = None
+        rows = []
         for record in records:
-            columns = ",".join(map(str, list(record.keys())))
-            qms = ', '.join(['?'] * len(record.values()))
-            query = """insert into predicted_drug_products ({}) values ({})""".format(columns, qms)
-            self.cursor.execute(query, list(record.values()))
+            if sql_insert is None:
+                sql_insert = """insert into predicted_drug_products ({}) values ({})""".format(
+                    ",".join(map(str, record.keys())), ", ".join(["?"] * len(record)))
+            rows.append(list(record.values()))
+        if len(rows) > 0:
+            self.cursor.executemany(sql_insert, rows)
         self.conn.commit()
 
+    _col_names = ["compound_id", "compound_name", "smiles", "sygma_score", "sygma_pathway", "parent", "exact_mass", "C", "H", "N", "O", "P", "S", "CHNOPS", "molecular_formula"]
+    _sql_select = """SELECT {} FROM predicted_drug_products WHERE
+                  exact_mass >= ? and exact_mass <= ?
+                  """.format(",".join(map(str, _col_names)))
+
     def select(self, min_tol, max_tol):
-        col_names = ["compound_id", "compound_name", "smiles", "sygma_score", "sygma_pathway", "parent", "exact_mass", "C", "H", "N", "O", "P", "S", "CHNOPS", "molecular_formula"]
-        self.cursor.execute("""SELECT {} FROM predicted_drug_products WHERE 
-                            exact_mass >= {} and exact_mass <= {}
-                            """.format(",".join(map(str, col_names)), min_tol, max_tol))
-        return [OrderedDict(zip(col_names, list(record))) for record in self.cursor.fetchall()]
+        self.cursor.execute(self._sql_select, (min_tol, max_tol))
+        return [OrderedDict(zip(self._col_names, list(record))) for record in self.cursor.fetchall()]
+
+    def select_ranges(self, names, mzs, min_tols, max_tols):
+        # one ranged join for all peaks; ordered to match per-peak
+        # index scans on exact_mass
+        self.cursor.execute("DROP TABLE IF EXISTS peaks_range")
+        self.cursor.execute("""CREATE TEMP TABLE peaks_range (
+                            name TEXT, mz REAL, min_tol REAL, max_tol REAL);""")
+        self.cursor.executemany("""insert into peaks_range (name, mz, min_tol, max_tol) values (?,?,?,?)""",
+                                list(zip(names, mzs, min_tols, max_tols)))
+
+        self.cursor.execute("""SELECT p.name, p.mz, {} from peaks_range as p, predicted_drug_products as d
+                            where d.exact_mass >= p.min_tol and d.exact_mass <= p.max_tol
+                            ORDER BY p.rowid, d.exact_mass, d.rowid
+                            """.format(",".join(["d.{}".format(c) for c in self._col_names])))
+
+        return [(record[0], record[1], OrderedDict(zip(self._col_names, record[2:])))
+                for record in self.cursor.fetchall()]
 
     def close(self):
         self.conn.close()
 
 
-def annotate_drug_products(peaklist, db_out, list_smiles, lib_adducts, ppm, phase1_cycles, phase2_cycles):
+def _sygma_parent_entries(smiles_parent, phase1_cycles, phase2_cycles):
+    # picklable per-parent worker: runs the SyGMa scenario and extracts
+    # (smiles, pathway, parent smiles, score, composition) tuples, so only
+    # plain Python objects cross process boundaries
+    from rdkit import Chem
+
+    metabolic_tree = predict_drug_products(smiles_parent, phase1_cycles, phase2_cycles)
+    # every metabolite of a tree shares its parent molecule, so the
+    # canonical parent SMILES is computed once per molecule, not per entry
+    parent_smiles = {}
+    entries = []
+    for entry in metabolic_tree.to_list():
+        smiles_product = Chem.MolToSmiles(entry['SyGMa_metabolite'])
+        mf = Chem.rdMolDescriptors.CalcMolFormula(Chem.MolFromSmiles(smiles_product))
+        parent_mol = entry["parent"]
+        if id(parent_mol) not in parent_smiles:
+            parent_smiles[id(parent_mol)] = Chem.MolToSmiles(parent_mol)
+        entries.append((smiles_product, entry["SyGMa_pathway"], parent_smiles[id(parent_mol)],
+                        entry['SyGMa_score'], pyteomics_mass.Composition(mf)))
+    return entries
+
+
+def annotate_drug_products(peaklist, db_out, list_smiles, lib_adducts, ppm, phase1_cycles, phase2_cycles, ncpus=None):
 
     try:
         from rdkit import Chem
@@ -844,8 +1248,7 @@ def annotate_drug_products(peaklist, db_out, list_smiles, lib_adducts, ppm, phas
     except ImportError:
         raise ImportError('Install RDKit and/or SyGMa')
 
-    conn = sqlite3.connect(db_out)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db_out)
 
     cursor.execute("DROP TABLE IF EXISTS drug_products")
     cursor.execute("""CREATE TABLE drug_products (
@@ -872,50 +1275,86 @@ def annotate_drug_products(peaklist, db_out, list_smiles, lib_adducts, ppm, phas
                    );""")
 
     path_nist_database = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nist_database.txt')
-    nist_database = nist_database_to_pyteomics(path_nist_database)
+    nist_database = _nist_database(path_nist_database)
 
-    records = []
+    # canonicalise and dedupe the parents so repeated or differently written
+    # SMILES do not trigger redundant SyGMa scenario runs
+    parents = OrderedDict()
     for smiles_parent in list_smiles:
-        metabolic_tree = predict_drug_products(smiles_parent, phase1_cycles, phase2_cycles)
-        for entry in metabolic_tree.to_list():
-            smiles_product = Chem.MolToSmiles(entry['SyGMa_metabolite'])
-            record = OrderedDict()
-            record["compound_id"] = smiles_product
-            record["compound_name"] = smiles_product
-            record["sygma_pathway"] = entry["SyGMa_pathway"]
-            record["parent"] = Chem.MolToSmiles(entry["parent"])
-            mf = Chem.rdMolDescriptors.CalcMolFormula(Chem.MolFromSmiles(smiles_product))
-            record["smiles"] = smiles_product
-            record["sygma_score"] = entry['SyGMa_score']
-            comp = pyteomics_mass.Composition(mf)
-            record.update(comp)
-            record["molecular_formula"] = composition_to_string(comp)
-            record["exact_mass"] = round(pyteomics_mass.calculate_mass(formula=str(mf), mass_data=nist_database), 6)
-            record["CHNOPS"] = sum([comp[e] for e in comp if e in ["C", "H", "N", "O", "P", "S"]]) == sum(list(comp.values()))
-            records.append(record)
+        parents.setdefault(Chem.MolToSmiles(Chem.MolFromSmiles(str(smiles_parent))), None)
+
+    # independent parents are embarrassingly parallel; the SQLite work
+    # below stays on this process
+    if ncpus is not None and ncpus > 1 and len(parents) > 1:
+        with ProcessPoolExecutor(max_workers=ncpus) as executor:
+            entry_lists = list(executor.map(functools.partial(_sygma_parent_entries,
+                                                              phase1_cycles=phase1_cycles,
+                                                              phase2_cycles=phase2_cycles),
+                                            parents))
+    else:
+        entry_lists = [_sygma_parent_entries(smiles_parent, phase1_cycles, phase2_cycles)
+                       for smiles_parent in parents]
+    entries = [entry for entry_list in entry_lists for entry in entry_list]
+
+    # exact masses and CHNOPS flags for all metabolites at once from a
+    # (metabolites x elements) composition matrix against the NIST masses
+    elems = list(order_composition_by_hill({e for entry in entries for e in entry[4]}))
+    mass_vec = np.array([nist_database[e][0][0] for e in elems])
+    comp_mat = np.zeros((len(entries), len(elems)), dtype=np.int32)
+    for i, entry in enumerate(entries):
+        for j, e in enumerate(elems):
+            if e in entry[4]:
+                comp_mat[i, j] = entry[4][e]
+    exact_masses = np.round(comp_mat.dot(mass_vec), 6)
+
+    records = []
+    for i, (smiles_product, sygma_pathway, parent, sygma_score, comp) in enumerate(entries):
+        record = OrderedDict()
+        record["compound_id"] = smiles_product
+        record["compound_name"] = smiles_product
+        record["sygma_pathway"] = sygma_pathway
+        record["parent"] = parent
+        record["smiles"] = smiles_product
+        record["sygma_score"] = sygma_score
+        # restricted to CHNOPS on emit; absent elements get the column
+        # default explicitly so every record shares one key order
+        record.update((e, comp.get(e, 0)) for e in ("C", "H", "N", "O", "P", "S"))
+        record["molecular_formula"] = composition_to_string(comp)
+        record["exact_mass"] = float(exact_masses[i])
+        record["CHNOPS"] = not (comp.keys() - _CHNOPS)
+        records.append(record)
 
     conn_mem = DbDrugCompoundsMemory()
-    records = _remove_elements_from_compositions(records, keep=["C", "H", "N", "O", "P", "S"])
     conn_mem.insert(records)
 
-    for i in range(len(peaklist.iloc[:, 0])):
-        mz = float(peaklist["mz"].iloc[i])
-        name = str(peaklist["name"].iloc[i])
-        min_tol, max_tol = calculate_mz_tolerance(mz, ppm)
-        for adduct in lib_adducts.lib:
-
-            if mz - lib_adducts.lib[adduct] > 0.5:
-
-                records = conn_mem.select(min_tol - lib_adducts.lib[adduct], max_tol - lib_adducts.lib[adduct])
-
-                for record in records:
-                    record["id"] = name
-                    record["exact_mass"] = record["exact_mass"] + float(lib_adducts.lib[adduct])
-                    record["mz"] = mz
-                    record["ppm_error"] = calculate_ppm_error(mz, record["exact_mass"])
-                    record["adduct"] = adduct
-                    cursor.execute("""insert into drug_products ({}) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                                   """.format(",".join(map(str, list(record.keys())))), list(record.values()))
+    mzs = peaklist["mz"].to_numpy(dtype=np.float64)
+    names = peaklist["name"].to_numpy()
+    min_tols, max_tols = calculate_mz_tolerance(mzs, ppm)
+
+    # one ranged join per adduct instead of one query per (peak, adduct);
+    # values are regrouped per peak to keep the original insertion order
+    sql_insert = None
+    values_by_peak = OrderedDict((str(name), []) for name in names)
+
+    for adduct, shift in lib_adducts.lib.items():
+
+        sel = mzs - shift > 0.5
+
+        for name, mz, record in conn_mem.select_ranges(names[sel], mzs[sel],
+                                                       min_tols[sel] - shift, max_tols[sel] - shift):
+            record["id"] = name
+            record["exact_mass"] = record["exact_mass"] + shift
+            record["mz"] = mz
+            record["ppm_error"] = calculate_ppm_error(mz, record["exact_mass"])
+            record["adduct"] = adduct
+            if sql_insert is None:
+                sql_insert = """insert into drug_products ({}) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                             """.format(",".join(map(str, list(record.keys()))))
+            values_by_peak[name].append(list(record.values()))
+
+    rows = [vs for peak_values in values_by_peak.values() for vs in peak_values]
+    if len(rows) > 0:
+        cursor.executemany(sql_insert, rows)
     conn.commit()
     conn.close()
     return
@@ -923,11 +1362,12 @@ def annotate_drug_products(peaklist, db_out, list_smiles, lib_adducts, ppm, phas
 
 def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndigits_mz=None):
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    conn, cursor = _connect_results_db(db)
 
     cursor.execute("DROP TABLE IF EXISTS peaklist")
-    df[["name", "mz", "rt", "intensity"]].to_sql("peaklist", conn, index=False)
+    # multi-row inserts; 200 rows keeps the bound parameters per statement
+    # below the historical SQLite limit of 999
+    df[["name", "mz", "rt", "intensity"]].to_sql("peaklist", conn, index=False, method="multi", chunksize=200)
 
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
     tables = cursor.fetchall()
@@ -949,15 +1389,38 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
 
         records = [(str(record[0]), str(record[1])) for record in cursor.fetchall()]
 
-        G = nx.OrderedDiGraph()
-        G.add_edges_from(records)
-
-        graphs = list(G.subgraph(c) for c in nx.weakly_connected_components(G))
-
         to_add = []
-        for i, g in enumerate(graphs):
-            for n in g.nodes():
-                to_add.append([i+1, n, g.degree(n), g.number_of_nodes(), g.number_of_edges()])
+        if len(records) > 0:
+            rec_arr = np.array(records)
+            edges = np.unique(rec_arr, axis=0)  # parallel edges collapse, as in a graph
+
+            seq = rec_arr.ravel()  # node ids in insertion order: a0, b0, a1, b1, ...
+            nodes = np.unique(seq)
+            nodes_in_order = seq[np.sort(np.unique(seq, return_index=True)[1])]
+
+            ai = np.searchsorted(nodes, edges[:, 0])
+            bi = np.searchsorted(nodes, edges[:, 1])
+            adjacency = coo_matrix((np.ones(len(ai)), (ai, bi)), shape=(len(nodes), len(nodes)))
+            n_comp, labels = connected_components(adjacency, directed=False)
+
+            degrees = np.bincount(ai, minlength=len(nodes)) + np.bincount(bi, minlength=len(nodes))
+            n_nodes = np.bincount(labels, minlength=n_comp)
+            n_edges = np.bincount(labels[ai], minlength=n_comp)
+
+            # number the components by first appearance and emit the nodes
+            # component-by-component, matching the traversal order of
+            # nx.weakly_connected_components on an insertion-ordered graph
+            idx_in_order = np.searchsorted(nodes, nodes_in_order)
+            labels_in_order = labels[idx_in_order]
+            uniq_labels, first_pos = np.unique(labels_in_order, return_index=True)
+            sub_group_ids = np.empty(n_comp, dtype=np.int64)
+            sub_group_ids[uniq_labels[np.argsort(first_pos)]] = np.arange(1, n_comp + 1)
+
+            for j in np.argsort(sub_group_ids[labels_in_order], kind="stable"):
+                node_idx = idx_in_order[j]
+                label = labels[node_idx]
+                to_add.append([int(sub_group_ids[label]), str(nodes_in_order[j]), int(degrees[node_idx]),
+                               int(n_nodes[label]), int(n_edges[label])])
 
         cursor.execute("""CREATE TEMPORARY TABLE sub_groups (
                            sub_group_id INTEGER DEFAULT NULL,
@@ -969,6 +1432,7 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
 
         cursor.executemany("""insert into sub_groups (sub_group_id, peak_id, degree, n_nodes, n_edges) 
                            values (?,?,?,?,?)""", to_add)
+        cursor.execute("ANALYZE sub_groups")
 
         columns_groupings = """peak_id, group_id, degree_cor, sub_group_id, degree, n_nodes, n_edges"""
 
@@ -980,6 +1444,11 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
                           select group_id, peak_id_b as peak_id, degree_b as degree_cor from groups) AS gr
                           LEFT JOIN sub_groups
                           ON gr.peak_id = sub_groups.peak_id"""
+
+        cursor.execute("CREATE TEMPORARY TABLE grp_lbl AS " + query_groupings)
+        cursor.execute("CREATE INDEX ix_grp_lbl ON grp_lbl (peak_id)")
+        cursor.execute("ANALYZE grp_lbl")
+        query_groupings = "select * from grp_lbl"
     else:
         query_groupings = ""
         columns_groupings = ""
@@ -1006,6 +1475,11 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
         columns_amo = ", label, charge, oligomer"
         query_amo = " union ".join(map(str, sub_queries))
 
+        cursor.execute("CREATE TEMPORARY TABLE amo_lbl AS " + query_amo)
+        cursor.execute("CREATE INDEX ix_amo_lbl ON amo_lbl (peak_id_amo)")
+        cursor.execute("ANALYZE amo_lbl")
+        query_amo = "select * from amo_lbl"
+
     if flag_isotopes:
         columns_isotopes = ", isotope_labels_a, isotope_ids, isotope_labels_b, atoms"
         query_isotopes = """SELECT peak_id_a, group_concat(label_a) as isotope_labels_a,
@@ -1018,49 +1492,55 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
                             from isotopes
                             ) group by peak_id_a"""
 
+        cursor.execute("CREATE TEMPORARY TABLE iso_agg AS " + query_isotopes)
+        cursor.execute("CREATE INDEX ix_iso_agg ON iso_agg (peak_id_a)")
+        cursor.execute("ANALYZE iso_agg")
+        query_isotopes = "select * from iso_agg"
+
     cursor.execute("DROP TABLE IF EXISTS peak_labels")
+    select_labels = None
+    label_columns = []
     if flag_amo and flag_isotopes:
-        query = "CREATE TABLE peak_labels as "
         if query_groupings != "":
-            query += "SELECT {}{}{} from """.format(columns_groupings, columns_amo, columns_isotopes)
-            query += "({}) LEFT JOIN ({}) ON peak_id = peak_id_amo LEFT JOIN ({}) ON peak_id = peak_id_a".format(query_groupings, query_amo, query_isotopes)
+            select_labels = "SELECT {}{}{} from """.format(columns_groupings, columns_amo, columns_isotopes)
+            select_labels += "({}) LEFT JOIN ({}) ON peak_id = peak_id_amo LEFT JOIN ({}) ON peak_id = peak_id_a".format(query_groupings, query_amo, query_isotopes)
+            label_columns = columns_groupings.split(", ")
         else:
-            query += "SELECT peaklist.name as peak_id{}{} from ".format(columns_amo, columns_isotopes)
-            query += "peaklist LEFT JOIN ({}) ON peaklist.name = peak_id LEFT JOIN ({}) ON peaklist.name = peak_id_a".format(query_amo, query_isotopes)
-            query = query.replace("peak_id_amo", "peak_id")
-        cursor.execute(query)
+            select_labels = "SELECT peaklist.name as peak_id{}{} from ".format(columns_amo, columns_isotopes)
+            select_labels += "peaklist LEFT JOIN ({}) ON peaklist.name = peak_id_amo LEFT JOIN ({}) ON peaklist.name = peak_id_a".format(query_amo, query_isotopes)
+            label_columns = ["peak_id"]
+        label_columns += ["label", "charge", "oligomer", "isotope_labels_a", "isotope_ids", "isotope_labels_b", "atoms"]
     elif flag_isotopes and not flag_amo:
-        query = "CREATE TABLE peak_labels as "
         if query_groupings != "":
-            query += "select {}{} from ".format(columns_groupings, columns_isotopes)
-            query += "({}) LEFT JOIN ({}) ON peak_id = peak_id_a".format(query_groupings, query_isotopes)
+            select_labels = "select {}{} from ".format(columns_groupings, columns_isotopes)
+            select_labels += "({}) LEFT JOIN ({}) ON peak_id = peak_id_a".format(query_groupings, query_isotopes)
         else:
-            query += query_isotopes
-        cursor.execute(query)
+            select_labels = query_isotopes
     elif not flag_isotopes and flag_amo:
-        query = "CREATE TABLE peak_labels as "
         if query_groupings != "":
-            query += """select {}{} from """.format(columns_groupings, columns_amo)
-            query += """({}) LEFT JOIN ({}) ON peak_id = peak_id_amo""".format(query_groupings, query_amo)
+            select_labels = """select {}{} from """.format(columns_groupings, columns_amo)
+            select_labels += """({}) LEFT JOIN ({}) ON peak_id = peak_id_amo""".format(query_groupings, query_amo)
+            label_columns = columns_groupings.split(", ")
         else:
-            query += query_amo.replace("peak_id_amo", "peak_id")
-        cursor.execute(query)
-    if flag_amo:
-        cursor.execute('PRAGMA table_info("peak_labels")')
-        columns = cursor.fetchall()
-
-        set_to_NULL = ["label", "charge", "oligomer"]
-        columns_to_select = []
-        for cn in columns:
-            if cn[1] in set_to_NULL:
-                columns_to_select.append("NULL")
-            else:
-                columns_to_select.append(cn[1])
-
-        query = "INSERT INTO peak_labels"
-        query += " SELECT {} FROM peak_labels where label is not NULL".format(", ".join(map(str, columns_to_select)))
+            select_labels = "select peak_id_amo as peak_id{} from amo_lbl".format(columns_amo)
+            label_columns = ["peak_id"]
+        label_columns += ["label", "charge", "oligomer"]
 
+    if select_labels is not None:
+        query = "CREATE TABLE peak_labels as "
+        if flag_amo:
+            # rows with label/charge/oligomer cleared are appended in the
+            # same statement instead of a reflect-then-insert round-trip
+            set_to_NULL = ["label", "charge", "oligomer"]
+            nulled = ", ".join(["NULL" if cn in set_to_NULL else cn for cn in label_columns])
+            query += "WITH base as ({}) SELECT * from base".format(select_labels)
+            query += " UNION ALL SELECT {} from base where label is not NULL".format(nulled)
+        else:
+            query += select_labels
         cursor.execute(query)
+        if flag_amo:
+            cursor.execute("CREATE INDEX idx_peak_labels_peak_id ON peak_labels (peak_id, label)")
+            cursor.execute("ANALYZE peak_labels")
         conn.commit()
 
     cpd_tables = [tn[0] for tn in tables if "compound" in tn[0]]
@@ -1085,8 +1565,29 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
         unions_cpd_query += " union select * from ".join(map(str, cpd_tables))
 
         cursor.execute(unions_cpd_query)
+        cursor.execute("CREATE INDEX idx_compounds_mf_adduct ON compounds (molecular_formula, adduct)")
+        cursor.execute("ANALYZE compounds")
         unions_cpd_sub_query = ""
 
+        cursor.execute("""CREATE INDEX IF NOT EXISTS idx_mf_mf_adduct
+                       ON molecular_formulae (molecular_formula, adduct)""")
+        cursor.execute("ANALYZE molecular_formulae")
+
+        # one pass over each table via FULL JOIN (SQLite >= 3.39): rows
+        # without a formula match fall back to the compound columns, which
+        # is exactly what the two-scan UNION below produced
+        mf_cd_columns = ["id", "exact_mass", "ppm_error", "adduct", "C", "H", "N", "O", "P", "S", "molecular_formula"]
+        query_full = """CREATE TEMP TABLE mf_cd as
+                     SELECT DISTINCT {},
+                     cpds.compound_name, cpds.compound_id
+                     FROM molecular_formulae as mf
+                     FULL JOIN compounds as cpds
+                     ON mf.molecular_formula = cpds.molecular_formula AND mf.adduct = cpds.adduct
+                     ORDER BY {}
+                     """.format(", ".join(["CASE WHEN mf.rowid IS NULL THEN cpds.{0} ELSE mf.{0} END as {0}".format(cn)
+                                          for cn in mf_cd_columns]),
+                                ", ".join(map(str, range(1, len(mf_cd_columns) + 3))))
+
         query = """CREATE TEMP TABLE mf_cd as
                    SELECT mf.id, mf.exact_mass, mf.ppm_error, mf.adduct, mf.C, mf.H, mf.N, mf.O, mf.P, mf.S,
                    mf.molecular_formula, cpds.compound_name, cpds.compound_id
@@ -1101,7 +1602,12 @@ def summary(df, db, single_row=False, single_column=False, convert_rt=None, ndig
                    ON mf.molecular_formula = cpds.molecular_formula AND mf.adduct = cpds.adduct
                    WHERE mf.molecular_formula IS NULL"""
 
-        cursor.execute(query)
+        try:
+            cursor.execute(query_full)
+        except sqlite3.OperationalError:  # FULL JOIN not supported
+            cursor.execute(query)
+        cursor.execute("CREATE INDEX idx_mf_cd_id ON mf_cd (id)")
+        cursor.execute("ANALYZE mf_cd")
 
         # mf_cpc_columns = "".join(map(str, [", mf.{} as {}".format(c, c) for c in columns]))
         # mf_cpc_columns += ", ct.compound_name as compound_name, ct.compound_id as compound_id"
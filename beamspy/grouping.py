@@ -8,9 +8,19 @@ import networkx as nx
 
 def group_features(df, db_out, max_rt_diff=5.0, coeff_thres=0.7, pvalue_thres=1.0, method="pearson", block=5000, ncpus=None):
 
-    conn = sqlite3.connect(db_out)
+    # uri=True so "file:" names (e.g. shared in-memory databases) are
+    # accepted; plain paths are opened as before
+    conn = sqlite3.connect(db_out, uri=True)
     cursor = conn.cursor()
 
+    # the groups table is rebuilt from scratch on every run, so durability
+    # pragmas are traded for write speed (same policy as the result
+    # databases written by beamspy.annotation)
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA journal_mode = MEMORY")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA cache_size = -64000")
+
     cursor.execute("DROP TABLE IF EXISTS groups")
 
     cursor.execute("""CREATE TABLE groups (
@@ -3,63 +3,115 @@
 
 import unittest
 import gzip
-import shutil
+import os
+import sqlite3
+import uuid
+from functools import lru_cache
 import pandas as pd
-import filecmp
 
-from beamspy.annotation import *
+from beamspy.annotation import (annotate_adducts, annotate_isotopes, annotate_oligomers,
+                                annotate_compounds, annotate_molecular_formulae, summary)
 from beamspy.grouping import group_features
-from beamspy.in_out import *
-from tests.utils import *
+from beamspy.in_out import read_isotopes, read_adducts, read_multiple_charged_ions
+from tests.utils import (to_test_data, to_test_results, to_test_results_mem, sqlite_records, sqlite_count,
+                         sqlite_table_digest, shared_df, pearson_graph, golden_conn)
 
+# constant across the whole run, so resolved once at import
+_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_DATA = os.path.join(_PATH, "beamspy", "data")
+_ISOTOPES = os.path.join(_DATA, "isotopes.txt")
+_ADDUCTS = os.path.join(_DATA, "adducts.txt")
+_MULTIPLE_CHARGED_IONS = os.path.join(_DATA, "multiple_charged_ions.txt")
+_DB_COMPOUNDS = os.path.join(_DATA, "db_compounds.txt")
+_DB_MF = os.path.join(_DATA, "db_mf.txt")
+_HMDB_SQL_GZ = os.path.join(_DATA, "databases", "hmdb_full_v4_0_v1.sql.gz")
 
-class AnnotationTestCase(unittest.TestCase):
-
-    def setUp(self):
 
-        self.df = combine_peaklist_matrix(to_test_data("peaklist_lcms_pos_theoretical.txt"), to_test_data("dataMatrix_lcms_theoretical.txt"))
-        self.path, f = os.path.split(os.path.dirname(os.path.abspath(__file__)))
+@lru_cache(maxsize=None)
+def _golden_digest(path, table):
+    # the golden databases under test_data are read-only, so their
+    # table digests are computed once, from the session-wide in-memory
+    # clone, and shared across tests
+    return sqlite_table_digest(path, table, conn=golden_conn(path))
 
-        self.lib_isotopes = read_isotopes(os.path.join(self.path, "beamspy", "data", "isotopes.txt"), "pos")
-        self.lib_adducts = read_adducts(os.path.join(self.path, "beamspy", "data", "adducts.txt"), "pos")
-        self.lib_multiple_charged_ions = read_multiple_charged_ions(os.path.join(self.path, "beamspy", "data", "multiple_charged_ions.txt"), "pos")
-        # lib_mass_differences = read_mass_differences(os.path.join(self.path, "beamspy", "data", "multiple_charged_differences.txt"), "pos")
 
-        self.db_results = "results_annotation.sqlite"
-        self.db_results_graph = "results_annotation_graph.sqlite"
-        self.graph = group_features(self.df, to_test_results(self.db_results_graph), max_rt_diff=5.0, coeff_thres=0.7, pvalue_thres=1.0, method="pearson", block=5000, ncpus=None)
+class AnnotationTestCase(unittest.TestCase):
 
-        self.ppm = 2.0
+    @classmethod
+    def setUpClass(cls):
 
-    #def tearDown(self):
-    #    os.remove(to_test_results("hmdb_full_v4_0_v1.sqlite"))
+        # none of these fixtures are mutated by the tests; the peaklist
+        # parse and pearson build are shared session-wide via tests.utils
+        cls.df = shared_df()
 
-    def test_annotate_adducts(self):
-        annotate_adducts(self.df, to_test_results(self.db_results), self.ppm, self.lib_adducts)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results), "adduct_pairs"), sqlite_records(to_test_data(self.db_results), "adduct_pairs"))
+        cls.lib_isotopes = read_isotopes(_ISOTOPES, "pos")
+        cls.lib_adducts = read_adducts(_ADDUCTS, "pos")
+        cls.lib_multiple_charged_ions = read_multiple_charged_ions(_MULTIPLE_CHARGED_IONS, "pos")
+        # lib_mass_differences = read_mass_differences(os.path.join(_DATA, "multiple_charged_differences.txt"), "pos")
 
-        annotate_adducts(self.graph, to_test_results(self.db_results_graph), self.ppm, self.lib_adducts)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results_graph), "adduct_pairs"), sqlite_records(to_test_data(self.db_results_graph), "adduct_pairs"))
+        cls.db_results = "results_annotation.sqlite"
+        cls.db_results_graph = "results_annotation_graph.sqlite"
+        _, cls.graph = pearson_graph()
 
-    def test_annotate_isotopes(self):
-        annotate_isotopes(self.df, to_test_results(self.db_results), self.ppm, self.lib_isotopes)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results), "isotopes"), sqlite_records(to_test_data(self.db_results), "isotopes"))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results), "isotopes"), 1)
+        cls.ppm = 2.0
 
-        annotate_isotopes(self.graph, to_test_results(self.db_results_graph), self.ppm, self.lib_isotopes)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results_graph), "isotopes"), sqlite_records(to_test_data(self.db_results_graph), "isotopes"))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results_graph), "isotopes"), 1)
+    def setUp(self):
+        self._keepers = []
 
-    def test_annotate_oligomers(self):
-        annotate_oligomers(self.df, to_test_results(self.db_results), self.ppm, self.lib_adducts, maximum=5)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results), "oligomers"),
-                         sqlite_records(to_test_data(self.db_results), "oligomers"))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results), "oligomers"), 2)
+    def tearDown(self):
+        # closing the keeper connections drops the in-memory databases
+        for conn in self._keepers:
+            conn.close()
 
-        annotate_oligomers(self.graph, to_test_results(self.db_results_graph), self.ppm, self.lib_adducts)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results_graph), "oligomers"),
-                         sqlite_records(to_test_data(self.db_results_graph), "oligomers"))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results_graph), "oligomers"), 2)
+    def _fresh_db(self, tag):
+        # unique in-memory target per test, so tests neither contend on one
+        # result file nor pay journal fsyncs; golden paths are unchanged
+        uri = to_test_results_mem("results_annotation_{}_{}".format(tag, uuid.uuid4().hex))
+        self._keepers.append(sqlite3.connect(uri, uri=True))
+        return uri
+
+    def test_annotate_adducts_df(self):
+        db_out = self._fresh_db("adducts")
+        annotate_adducts(self.df, db_out, self.ppm, self.lib_adducts)
+        self.assertEqual(sqlite_table_digest(db_out, "adduct_pairs"), _golden_digest(to_test_data(self.db_results), "adduct_pairs"))
+
+    def test_annotate_adducts_single_entry_library(self):
+        # a one-adduct library yields no candidate pairs and an empty table
+        db_out = self._fresh_db("adducts_single")
+        lib = read_adducts(_ADDUCTS, "pos")
+        for label in list(lib.lib)[1:]:
+            del lib.lib[label]
+        annotate_adducts(self.df, db_out, self.ppm, lib)
+        self.assertEqual(sqlite_count(db_out, "adduct_pairs"), 0)
+
+    def test_annotate_adducts_graph(self):
+        db_out = self._fresh_db("adducts_graph")
+        annotate_adducts(self.graph, db_out, self.ppm, self.lib_adducts)
+        self.assertEqual(sqlite_table_digest(db_out, "adduct_pairs"), _golden_digest(to_test_data(self.db_results_graph), "adduct_pairs"))
+
+    def test_annotate_isotopes_df(self):
+        db_out = self._fresh_db("isotopes")
+        annotate_isotopes(self.df, db_out, self.ppm, self.lib_isotopes)
+        self.assertEqual(sqlite_table_digest(db_out, "isotopes"), _golden_digest(to_test_data(self.db_results), "isotopes"))
+        self.assertEqual(sqlite_count(db_out, "isotopes"), 1)
+
+    def test_annotate_isotopes_graph(self):
+        db_out = self._fresh_db("isotopes_graph")
+        annotate_isotopes(self.graph, db_out, self.ppm, self.lib_isotopes)
+        self.assertEqual(sqlite_table_digest(db_out, "isotopes"), _golden_digest(to_test_data(self.db_results_graph), "isotopes"))
+        self.assertEqual(sqlite_count(db_out, "isotopes"), 1)
+
+    def test_annotate_oligomers_df(self):
+        db_out = self._fresh_db("oligomers")
+        annotate_oligomers(self.df, db_out, self.ppm, self.lib_adducts, maximum=5)
+        self.assertEqual(sqlite_table_digest(db_out, "oligomers"), _golden_digest(to_test_data(self.db_results), "oligomers"))
+        self.assertEqual(sqlite_count(db_out, "oligomers"), 2)
+
+    def test_annotate_oligomers_graph(self):
+        db_out = self._fresh_db("oligomers_graph")
+        annotate_oligomers(self.graph, db_out, self.ppm, self.lib_adducts)
+        self.assertEqual(sqlite_table_digest(db_out, "oligomers"), _golden_digest(to_test_data(self.db_results_graph), "oligomers"))
+        self.assertEqual(sqlite_count(db_out, "oligomers"), 2)
 
     # def test_annotate_drug_products(self):
     #     df = pd.DataFrame({"name": pd.Series(["M152T100", "M188T100", "M310T200", "M348T200"]),
@@ -69,23 +121,23 @@ class AnnotationTestCase(unittest.TestCase):
     #                        columns=["name", "mz", "rt", "intensity"],
     #                        index=range(0, 4))
     #     smiles = ["CC(=O)NC1=CC=C(C=C1)O", "CNCCC(OC1=CC=C(C=C1)C(F)(F)F)C1=CC=CC=C1"]
-    #     annotate_drug_products(df, to_test_results(self.db_results), smiles, self.lib_adducts, self.ppm,
+    #     annotate_drug_products(df, self._fresh_db("drug_products"), smiles, self.lib_adducts, self.ppm,
     #                            phase1_cycles=1, phase2_cycles=1)
     #     self.assertEqual(sqlite_records(to_test_results(self.db_results), "drug_products"),
-    #                      sqlite_records(to_test_data(self.db_results), "drug_products"))
+    #                      _golden_digest(to_test_data(self.db_results), "drug_products"))
     #     self.assertEqual(sqlite_count(to_test_results(self.db_results), "drug_products"), 4)
 
     def test_annotate_compounds(self):
 
         db_name = "hmdb_full_v4_0_v1"
+        db_out = self._fresh_db("compounds")
 
-        path_hmdb_sql_gz = os.path.join(os.getcwd(), "beamspy", "data", "databases", db_name + ".sql.gz")
         path_hmdb_sqlite = to_test_results("{}.sqlite".format(db_name))
 
         if os.path.isfile(path_hmdb_sqlite):
             os.remove(path_hmdb_sqlite)
 
-        with gzip.GzipFile(path_hmdb_sql_gz, mode='rb') as db_dump:
+        with gzip.GzipFile(_HMDB_SQL_GZ, mode='rb') as db_dump:
             conn = sqlite3.connect(path_hmdb_sqlite)
             cursor = conn.cursor()
             cursor.executescript(db_dump.read().decode('utf-8'))
@@ -93,35 +145,49 @@ class AnnotationTestCase(unittest.TestCase):
             conn.close()
 
         # sqlite profile provided
-        annotate_compounds(self.df, self.lib_adducts, self.ppm, to_test_results(self.db_results), db_name, path_hmdb_sqlite)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results), "compounds_{}".format(db_name)),
-                         sqlite_records(to_test_data(self.db_results), "compounds_{}".format(db_name)))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results), "compounds_{}".format(db_name)), 57)
+        annotate_compounds(self.df, self.lib_adducts, self.ppm, db_out, db_name, path_hmdb_sqlite)
+        self.assertEqual(sqlite_table_digest(db_out, "compounds_{}".format(db_name)), _golden_digest(to_test_data(self.db_results), "compounds_{}".format(db_name)))
+        self.assertEqual(sqlite_count(db_out, "compounds_{}".format(db_name)), 57)
 
         # internal sqlite databases
-        annotate_compounds(self.df, self.lib_adducts, self.ppm, to_test_results(self.db_results), db_name)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results), "compounds_{}".format(db_name)),
-                         sqlite_records(to_test_data(self.db_results), "compounds_{}".format(db_name)))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results), "compounds_{}".format(db_name)), 57)
+        annotate_compounds(self.df, self.lib_adducts, self.ppm, db_out, db_name)
+        self.assertEqual(sqlite_table_digest(db_out, "compounds_{}".format(db_name)), _golden_digest(to_test_data(self.db_results), "compounds_{}".format(db_name)))
+        self.assertEqual(sqlite_count(db_out, "compounds_{}".format(db_name)), 57)
 
-        path_db_txt = os.path.join(os.getcwd(), "beamspy", "data", "db_compounds.txt")
-        annotate_compounds(self.df, self.lib_adducts, self.ppm, to_test_results(self.db_results), "test", path_db_txt)
-        #self.assertEqual(sqlite_records(to_test_results(self.db_results), "compounds_{}".format(db_name)), sqlite_records(to_test_data(self.db_results), "compounds_{}".format(db_name)))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results), "compounds_{}".format(db_name)), 57)
+        annotate_compounds(self.df, self.lib_adducts, self.ppm, db_out, "test", _DB_COMPOUNDS)
+        #self.assertEqual(sqlite_table_digest(db_out, "compounds_{}".format(db_name)), _golden_digest(to_test_data(self.db_results), "compounds_{}".format(db_name)))
+        self.assertEqual(sqlite_count(db_out, "compounds_{}".format(db_name)), 57)
 
     def test_annotate_molecular_formulae(self):
-        fn_mf = os.path.join(self.path, "beamspy", "data", "db_mf.txt")
-        annotate_molecular_formulae(self.df, self.lib_adducts, self.ppm, to_test_results(self.db_results), fn_mf)
-        self.assertEqual(sqlite_records(to_test_results(self.db_results), "molecular_formulae"), sqlite_records(to_test_data(self.db_results), "molecular_formulae"))
-        self.assertEqual(sqlite_count(to_test_results(self.db_results), "molecular_formulae"), 16)
+        db_out = self._fresh_db("mf")
+        annotate_molecular_formulae(self.df, self.lib_adducts, self.ppm, db_out, _DB_MF)
+        self.assertEqual(sqlite_table_digest(db_out, "molecular_formulae"), _golden_digest(to_test_data(self.db_results), "molecular_formulae"))
+        self.assertEqual(sqlite_count(db_out, "molecular_formulae"), 16)
 
-        db_mfdb_results = "results_mfdb.sqlite"
-        annotate_molecular_formulae(self.df, self.lib_adducts, self.ppm, to_test_results(db_mfdb_results))
-        self.assertEqual(sqlite_records(to_test_results(db_mfdb_results), "molecular_formulae"), sqlite_records(to_test_data(db_mfdb_results), "molecular_formulae"))
-        self.assertEqual(sqlite_count(to_test_results(db_mfdb_results), "molecular_formulae"), 586)
+        db_mfdb_results = self._fresh_db("mfdb")
+        annotate_molecular_formulae(self.df, self.lib_adducts, self.ppm, db_mfdb_results)
+        self.assertEqual(sqlite_table_digest(db_mfdb_results, "molecular_formulae"), _golden_digest(to_test_data("results_mfdb.sqlite"), "molecular_formulae"))
+        self.assertEqual(sqlite_count(db_mfdb_results, "molecular_formulae"), 586)
 
     def test_summary(self):
 
+        # this test owns its result databases and reproduces every
+        # annotation the golden summaries were generated from, so it does
+        # not depend on the other tests having written to a shared file
+        db_results = self._fresh_db("summary")
+        annotate_adducts(self.df, db_results, self.ppm, self.lib_adducts)
+        annotate_isotopes(self.df, db_results, self.ppm, self.lib_isotopes)
+        annotate_oligomers(self.df, db_results, self.ppm, self.lib_adducts, maximum=5)
+        annotate_compounds(self.df, self.lib_adducts, self.ppm, db_results, "hmdb_full_v4_0_v1")
+        annotate_compounds(self.df, self.lib_adducts, self.ppm, db_results, "test", _DB_COMPOUNDS)
+        annotate_molecular_formulae(self.df, self.lib_adducts, self.ppm, db_results, _DB_MF)
+
+        db_results_graph = self._fresh_db("summary_graph")
+        group_features(self.df, db_results_graph, max_rt_diff=5.0, coeff_thres=0.7, pvalue_thres=1.0, method="pearson", block=5000, ncpus=None)
+        annotate_adducts(self.graph, db_results_graph, self.ppm, self.lib_adducts)
+        annotate_isotopes(self.graph, db_results_graph, self.ppm, self.lib_isotopes)
+        annotate_oligomers(self.graph, db_results_graph, self.ppm, self.lib_adducts)
+
         def _assert(summary_test_data, summary_result):
             with open(summary_result) as result:
                 with open(summary_test_data) as test_data:
@@ -129,27 +195,27 @@ class AnnotationTestCase(unittest.TestCase):
                     lines_test_data = test_data.read().splitlines()
                     for i in range(len(lines_results)):
                         self.assertEqual(lines_results[i], lines_test_data[i])
-                        self.assertEqual(sqlite_records(to_test_results(self.db_results), "summary"), sqlite_records(to_test_data(self.db_results), "summary"))
+                        self.assertEqual(sqlite_table_digest(db_results, "summary"), _golden_digest(to_test_data(self.db_results), "summary"))
 
         fn_summary = "summary_mr_mc.txt"
-        df_summary = summary(self.df, to_test_results(self.db_results), single_row=False, single_column=False, convert_rt=None, ndigits_mz=None)
+        df_summary = summary(self.df, db_results, single_row=False, single_column=False, convert_rt=None, ndigits_mz=None)
         df_summary.to_csv(to_test_results(fn_summary), sep="\t", index=False)
         _assert(to_test_data(fn_summary), to_test_results(fn_summary))
 
         fn_summary = "summary_sr_mc.txt"
-        df_summary = summary(self.df, to_test_results(self.db_results), single_row=True, single_column=False, convert_rt=None, ndigits_mz=None)
+        df_summary = summary(self.df, db_results, single_row=True, single_column=False, convert_rt=None, ndigits_mz=None)
         df_summary.to_csv(to_test_results(fn_summary), sep="\t", index=False)
         _assert(to_test_data(fn_summary), to_test_results(fn_summary))
 
         fn_summary = "summary_sr_sc.txt"
-        df_summary = summary(self.df, to_test_results(self.db_results), single_row=True, single_column=True, convert_rt=None, ndigits_mz=None)
+        df_summary = summary(self.df, db_results, single_row=True, single_column=True, convert_rt=None, ndigits_mz=None)
         df_summary.to_csv(to_test_results(fn_summary), sep="\t", index=False)
         _assert(to_test_data(fn_summary), to_test_results(fn_summary))
 
         fn_summary = "summary_mr_mc_graphs.txt"
-        df_summary = summary(self.df, to_test_results(self.db_results_graph), single_row=False, single_column=False, convert_rt=None, ndigits_mz=None)
+        df_summary = summary(self.df, db_results_graph, single_row=False, single_column=False, convert_rt=None, ndigits_mz=None)
         df_summary.to_csv(to_test_results(fn_summary), sep="\t", index=False)
         _assert(to_test_data(fn_summary), to_test_results(fn_summary))
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,59 +1,69 @@
 #!/usr/bin/env python
 #  -*- coding: utf-8 -*-
 
+import os
 import unittest
+import uuid
+from functools import lru_cache
 import numpy as np
-from tests.utils import to_test_data, to_test_results, sqlite_records
-from beamspy.in_out import combine_peaklist_matrix
+from tests.utils import to_test_data, to_test_results, sqlite_records, shared_df, pearson_graph, golden_conn
 from beamspy.grouping import group_features
 
 
+@lru_cache(maxsize=None)
+def _golden(path, table):
+    # the golden databases under test_data are read-only, so their
+    # records are fetched once, from the session-wide in-memory clone,
+    # and shared across tests
+    return tuple(sqlite_records(path, table, conn=golden_conn(path)))
+
+
 class GroupFeaturesTestCase(unittest.TestCase):
 
-    def setUp(self):
-        self.df = combine_peaklist_matrix(to_test_data("peaklist_lcms_pos_theoretical.txt"), to_test_data("dataMatrix_lcms_theoretical.txt"))
+    @classmethod
+    def setUpClass(cls):
+        cls.df = shared_df()
 
     def test_group_features(self):
-        fn_sql = "results_pearson.sqlite"
-        db_out = to_test_results(fn_sql)
-        group_features(self.df, db_out, max_rt_diff=5.0, coeff_thres=0.7, pvalue_thres=1.0, method="pearson", block=5000, ncpus=None)
-
-        records = sqlite_records(to_test_results(fn_sql), "groups")
-        records_comp = sqlite_records(to_test_data(fn_sql), "groups")
-        for i in range(len(records)):
-            self.assertEqual(records[i][0:6], records_comp[i][0:6])
-            np.testing.assert_allclose(records[i][6:], records_comp[i][6:], rtol=1e-8)
-
-        fn_sql = "results_pearson_all.sqlite"
-        db_out = to_test_results(fn_sql)
-        group_features(self.df, db_out, max_rt_diff=200.0, coeff_thres=0.0, pvalue_thres=1.0, method="pearson", block=5000, ncpus=None)
-
-        records = sqlite_records(to_test_results(fn_sql), "groups")
-        records_comp = sqlite_records(to_test_data(fn_sql), "groups")
-        for i in range(len(records)):
-            self.assertEqual(records[i][0:6], records_comp[i][0:6])
-            np.testing.assert_almost_equal(records[i][6:], records_comp[i][6:])
-
-        fn_sql = "results_pearson_all.sqlite"
-        db_out = to_test_results(fn_sql)
-        group_features(self.df, db_out, max_rt_diff=200.0, coeff_thres=0.0, pvalue_thres=1.0, method="pearson", block=20, ncpus=1)
-
-        records = sqlite_records(to_test_results(fn_sql), "groups")
-        records_comp = sqlite_records(to_test_data(fn_sql), "groups")
-        for i in range(len(records)):
-            self.assertEqual(records[i][0:6], records_comp[i][0:6])
-            np.testing.assert_almost_equal(records[i][6:], records_comp[i][6:])
-
-        fn_sql = "results_spearman.sqlite"
-        db_out = to_test_results(fn_sql)
-        group_features(self.df, db_out, max_rt_diff=5.0, coeff_thres=0.7, pvalue_thres=1.0, method="spearman", block=5000, ncpus=None)
-        records = sqlite_records(to_test_results(fn_sql), "groups")
-        records_comp = sqlite_records(to_test_data(fn_sql), "groups")
-
-        for i in range(len(records)):
-            self.assertEqual(records[i][0:6], records_comp[i][0:6])
-            np.testing.assert_almost_equal(records[i][6:], records_comp[i][6:])
+        # subTest rather than pytest.mark.parametrize so the module stays
+        # collectable by unittest discover (setup.py test_suite / green)
+        for fn_sql, max_rt_diff, coeff_thres, method, block, ncpus, rtol in [
+            ("results_pearson.sqlite", 5.0, 0.7, "pearson", 5000, None, 1e-8),
+            ("results_pearson_all.sqlite", 200.0, 0.0, "pearson", 5000, None, None),
+            ("results_pearson_all.sqlite", 200.0, 0.0, "pearson", 20, 1, None),
+            ("results_spearman.sqlite", 5.0, 0.7, "spearman", 5000, None, None),
+        ]:
+            with self.subTest(fn_sql=fn_sql, method=method, block=block, ncpus=ncpus):
+                if fn_sql == "results_pearson.sqlite":
+                    # same parameters as the session-wide pearson build shared
+                    # with the annotation tests, so validate that build instead
+                    # of repeating the heaviest correlation run
+                    db_out, _ = pearson_graph()
+                else:
+                    # unique writable target per case, so cases do not contend
+                    # on one file; the golden path under test_data is unchanged
+                    db_out = to_test_results(fn_sql.replace(".sqlite", "_{}.sqlite".format(uuid.uuid4().hex)))
+                try:
+                    if fn_sql != "results_pearson.sqlite":
+                        group_features(self.df, db_out, max_rt_diff=max_rt_diff, coeff_thres=coeff_thres, pvalue_thres=1.0,
+                                       method=method, block=block, ncpus=ncpus)
+
+                    records = sqlite_records(db_out, "groups")
+                    records_comp = _golden(to_test_data(fn_sql), "groups")
+                    self.assertEqual([r[0:6] for r in records], [r[0:6] for r in records_comp])
+                    coeffs = np.array([r[6:] for r in records], dtype=np.float64)
+                    coeffs_comp = np.array([r[6:] for r in records_comp], dtype=np.float64)
+                    # bit-identical arrays (the common case) pass on a single
+                    # memcmp; the tolerance check only runs when they differ
+                    if coeffs.tobytes() != coeffs_comp.tobytes():
+                        if rtol is not None:
+                            np.testing.assert_allclose(coeffs, coeffs_comp, rtol=rtol)
+                        else:
+                            np.testing.assert_almost_equal(coeffs, coeffs_comp)
+                finally:
+                    if os.path.isfile(db_out):
+                        os.remove(db_out)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,7 +1,29 @@
 #!/usr/bin/env python
 #  -*- coding: utf-8 -*-
+import hashlib
 import os
 import sqlite3
+from functools import lru_cache
+
+# keeps the shared in-memory pearson database alive for the session
+_keepers = []
+
+# in-memory clones of the golden databases, built on first access
+_golden_conns = {}
+
+
+def golden_conn(path):
+    # the golden databases are read many times but never written, so each
+    # is cloned into memory once per session via the backup API and the
+    # same connection handed out for every read
+    conn = _golden_conns.get(path)
+    if conn is None:
+        src = sqlite3.connect(path, uri=True)
+        conn = sqlite3.connect(":memory:")
+        src.backup(conn)
+        src.close()
+        _golden_conns[path] = conn
+    return conn
 
 
 def to_test_data(*args):
@@ -10,16 +32,66 @@ def to_test_data(*args):
 def to_test_results(*args):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_results", *args)
 
-def sqlite_records(db, table):
-    conn = sqlite3.connect(db)
+def to_test_results_mem(name):
+    # shared in-memory database; lives as long as at least one connection
+    # to it is open, so hold one for the duration of the test
+    return "file:mem_{}?mode=memory&cache=shared".format(name)
+
+@lru_cache(maxsize=None)
+def shared_df():
+    # the theoretical LC-MS peaklist used across test modules; parsed once
+    # per session and never mutated by the tests
+    from beamspy.in_out import combine_peaklist_matrix
+    return combine_peaklist_matrix(to_test_data("peaklist_lcms_pos_theoretical.txt"),
+                                   to_test_data("dataMatrix_lcms_theoretical.txt"))
+
+@lru_cache(maxsize=None)
+def pearson_graph():
+    # the pearson correlation build is the heaviest fixture in the suite
+    # and is identical between the annotation and grouping tests, so it
+    # runs once per session; returns the database name and the graph
+    from beamspy.grouping import group_features
+    uri = to_test_results_mem("pearson_graph_shared")
+    _keepers.append(sqlite3.connect(uri, uri=True))
+    graph = group_features(shared_df(), uri, max_rt_diff=5.0, coeff_thres=0.7, pvalue_thres=1.0,
+                           method="pearson", block=5000, ncpus=None)
+    return uri, graph
+
+def sqlite_records(db, table, conn=None):
+    # a caller-supplied connection is reused (and left open) when several
+    # tables are read from the same database
+    close = conn is None
+    if conn is None:
+        conn = sqlite3.connect(db, uri=True)
     cursor = conn.cursor()
+    cursor.arraysize = 1024
     cursor.execute("select * from {}".format(table))
-    records = cursor.fetchall()
-    conn.close()
+    records = []
+    while True:
+        chunk = cursor.fetchmany()
+        if not chunk:
+            break
+        records.extend(chunk)
+    if close:
+        conn.close()
     return records
 
+def sqlite_table_digest(db, table, conn=None):
+    # order-sensitive digest of a table's rows, for exact-equality
+    # assertions without materializing two lists of row tuples; a
+    # caller-supplied connection is reused and left open
+    close = conn is None
+    if conn is None:
+        conn = sqlite3.connect(db, uri=True)
+    h = hashlib.blake2b(digest_size=16)
+    for row in conn.execute("select * from {} ORDER BY rowid".format(table)):
+        h.update(repr(row).encode())
+    if close:
+        conn.close()
+    return h.digest()
+
 def sqlite_count(db, table):
-    conn = sqlite3.connect(db)
+    conn = sqlite3.connect(db, uri=True)
     cursor = conn.cursor()
     cursor.execute("select count(*) from {}".format(table))
     records = cursor.fetchone()[0]